@@ -0,0 +1,192 @@
+# jupyter-save-load-vars benchmarks.
+# Measures wall time, throughput, peak resident memory and file size of savevars, loadvars, printvars and whosvars
+# on generated workspaces of different shapes, and writes the results as JSON so that they can be compared over time.
+#
+# Run from the root of the project, e.g.
+#   python benchmarks/bench_saveloadvars.py --output bench.json
+#   python benchmarks/bench_saveloadvars.py --workload arrays --save-option compression=gzip --load-option mmap=True
+# Each workload and operation runs in its own python process so that peak memory is measured per operation.
+
+import argparse
+import ast
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+WORKLOADS = ('scalars', 'arrays', 'nested', 'frames', 'mixed')
+OPERATIONS = ('savevars', 'loadvars', 'printvars', 'whosvars')
+
+
+def make_workspace(workload, scale=1.0):
+    """ Generates the variables of a workload
+
+    :param workload: one of WORKLOADS
+    :param scale: multiplies the number or size of the variables
+    :returns: dict of variables, or None if the workload needs a module that is not installed
+    """
+    n = max(1, int(scale * 1000))
+    if workload == 'scalars':  # many small variables
+        workspace = {}
+        for i in range(10 * n):
+            workspace[f'i{i}'], workspace[f'f{i}'], workspace[f's{i}'] = i, i / 3, f'string {i}'
+        return workspace
+    if workload == 'nested':  # deep python containers
+        return {f'tree{i}': {'rows': [{'id': j, 'tags': ['a', 'b', str(j)], 'value': j * 0.5} for j in range(n)],
+                             'meta': {'name': f'tree {i}', 'sizes': list(range(100))}} for i in range(20)}
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+    rng = np.random.default_rng(0)
+    if workload == 'arrays':  # a few huge arrays, half of them compressible
+        return {'noise': rng.standard_normal(2000 * n), 'image': rng.integers(0, 255, (n, 4000), dtype=np.uint8),
+                'zeros': np.zeros((n, 2000)), 'ramp': np.arange(2000 * n, dtype=np.int64)}
+    if workload == 'frames':
+        try:
+            import pandas as pd
+        except ImportError:
+            return None
+        return {f'frame{i}': pd.DataFrame({'x': rng.standard_normal(100 * n), 'y': np.arange(100 * n),
+                                           'label': rng.choice(['a', 'b', 'c'], 100 * n)}) for i in range(4)}
+    if workload == 'mixed':  # picklable variables with unpicklable ones mixed in
+        import threading
+        workspace = make_workspace('scalars', scale / 10)
+        workspace.update(make_workspace('arrays', scale / 10))
+        workspace.update({f'gen{i}': (j for j in range(3)) for i in range(100)})
+        workspace.update({f'lock{i}': threading.Lock() for i in range(100)})
+        return workspace
+    raise ValueError(f'unknown workload {workload}')
+
+
+def peak_rss_mb():
+    """ :returns: the peak resident memory of this process in MB, or None if it cannot be measured """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, kB elsewhere
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / (1 << 20)
+    except ImportError:
+        return None
+
+
+def run_child(workload, operation, path, scale, repeat, save_options, load_options):
+    """ Runs one operation in this process and returns its measurements """
+    from jupyter_save_load_vars import savevars, loadvars, printvars, whosvars
+    quiet = dict(logging_level=logging.WARNING)
+    if operation == 'loadvars':
+        workspace = {}
+    else:
+        workspace = make_workspace(workload, scale)
+    rss_before = peak_rss_mb()
+    calls = {'savevars': 'savevars(path, overwrite=True, **save_options, **quiet)',
+             'loadvars': 'loadvars(path, overwrite=True, warn=False, **load_options, **quiet)',
+             'printvars': 'printvars(**quiet)', 'whosvars': 'whosvars(time_budget=None, **quiet)'}
+    functions = dict(savevars=savevars, loadvars=loadvars, printvars=printvars, whosvars=whosvars, path=path,
+                     quiet=quiet, save_options=save_options, load_options=load_options)
+    times = []
+    stdout = sys.stdout
+    for _ in range(repeat):
+        if operation in ('printvars', 'whosvars'):
+            sys.stdout = open(os.devnull, 'w')
+        start = time.perf_counter()
+        exec(calls[operation], functions, workspace)
+        if operation == 'loadvars' and load_options.get('lazy'):  # so that lazy loads are not measured as free
+            for v in workspace.values():
+                v.materialize()
+        times.append(time.perf_counter() - start)
+        if operation in ('printvars', 'whosvars'):
+            sys.stdout.close()
+            sys.stdout = stdout
+    rss_after = peak_rss_mb()
+    return {'seconds': min(times), 'median_seconds': sorted(times)[len(times) // 2], 'variables': len(workspace),
+            'peak_rss_mb': rss_after, 'extra_rss_mb': None if rss_before is None else rss_after - rss_before}
+
+
+def run(workloads, scale=1.0, repeat=3, save_options=None, load_options=None):
+    """ Runs the benchmarks, each workload and operation in a new python process
+
+    :returns: dict with the environment and a list of results
+    """
+    import dill
+    save_options, load_options = save_options or {}, load_options or {}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for workload in workloads:
+            path = os.path.join(tmp, f'{workload}.dill')
+            for operation in OPERATIONS:
+                args = [sys.executable, os.path.abspath(__file__), '--child', workload, operation, path,
+                        '--scale', str(scale), '--repeat', str(repeat),
+                        '--child-options', json.dumps([save_options, load_options])]
+                child = subprocess.run(args, stdout=subprocess.PIPE, check=True, text=True)
+                result = json.loads(child.stdout.splitlines()[-1])
+                if result is None:
+                    print(f'skipped {workload}: needs numpy or pandas', file=sys.stderr)
+                    break
+                file_mb = os.path.getsize(path) / (1 << 20) if os.path.exists(path) else None
+                result.update(workload=workload, operation=operation, file_mb=file_mb,
+                              mb_per_s=None if operation in ('printvars', 'whosvars') or not result['seconds']
+                              else file_mb / result['seconds'])
+                results.append(result)
+                print(f"{workload:>8} {operation:>9}: {result['seconds'] * 1000:9.1f} ms "
+                      f"{result['mb_per_s'] or 0:8.1f} MB/s  file {file_mb or 0:8.1f} MB  "
+                      f"peak RSS {result['peak_rss_mb'] or 0:8.1f} MB", file=sys.stderr)
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'dill': dill.__version__,
+            'scale': scale, 'repeat': repeat, 'save_options': save_options, 'load_options': load_options,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+
+def parse_options(options):
+    """ :returns: dict from a list of name=value strings; values are python literals or strings """
+    parsed = {}
+    for option in options or ():
+        name, _, value = option.partition('=')
+        try:
+            parsed[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            parsed[name] = value
+    return parsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks savevars, loadvars, printvars and whosvars')
+    parser.add_argument('--workload', action='append', choices=WORKLOADS,
+                        help='workload to run, may be repeated; default all')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the size of the workloads')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each operation; the fastest is reported')
+    parser.add_argument('--save-option', action='append', metavar='NAME=VALUE', help='savevars argument, e.g. workers=4')
+    parser.add_argument('--load-option', action='append', metavar='NAME=VALUE', help='loadvars argument, e.g. mmap=True')
+    parser.add_argument('--output', help='file to write the JSON results to; default stdout')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    parser.add_argument('--child-options', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        workload, operation, path = args.child
+        save_options, load_options = json.loads(args.child_options)
+        if make_workspace(workload, 0.001) is None:
+            print(json.dumps(None))
+            return
+        print(json.dumps(run_child(workload, operation, path, args.scale, args.repeat, save_options, load_options)))
+        return
+    report = run(args.workload or WORKLOADS, args.scale, args.repeat,
+                 parse_options(args.save_option), parse_options(args.load_option))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
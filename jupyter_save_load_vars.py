@@ -1,21 +1,60 @@
 # saveload vars
 
-import dill
 import logging
 import fnmatch  # unix wildcard variable naming to save
-from typing import Optional, Union  # variable typing for user hints
+import glob
+import contextlib
+from collections import deque  # pending futures of _map
+import hashlib  # content fingerprints of incremental savevars
+import importlib.util  # checks for optional compression modules
+import io
+import json  # header index of the container format
+import mmap  # memory mapping of out-of-band array buffers
+import operator  # forwarding of operators by LazyVar
+import os
+import pickle  # PickleBuffers of the native formats
+import struct  # fixed size fields of the container format
+import sys
+import threading  # lock of the cache of unpicklable types
+import time  # timings of profile=True reports
+import zlib  # crc32 checksums of the container format
+from pathlib import Path
+from types import ModuleType
+from typing import Callable, Optional, Union  # variable typing for user hints
 
-import logging
+# dill, numpy, pandas, pyarrow, the compression modules, tempfile, signal and concurrent.futures are imported
+# where they are first needed, so that importing this module (e.g. only for printvars or listvars) stays fast.
+# See _dill() for dill, which takes longer to import than everything else.
 
 # general logger. Produces nice output format with live hyperlinks for pycharm users
 # to use it, just call log=get_logger() at the top of your python file
 # all these loggers share the same logger name 'NE1'
 
 _LOGGING_LEVEL = logging.INFO  # usually INFO is good, DEBUG for debugging
+_LOGGER_NAME = 'saveloadvars'  # internal helpers log to it without changing the level set by get_logger
 _DEFAULT_FILENAME = 'saveloadvars-variables'
 _DILL_EXTENSION = '.dill'
 _RAN_SAVELOADVARS_TODAY_FILENAME = 'saveloadvars-ran.txt'
 
+# container format, see _ContainerWriter. Files without the magic are read as legacy single-dict dill files
+_CONTAINER_MAGIC = b'SLVARS\r\n'  # \r\n catches files mangled by text mode transfers
+_CONTAINER_END_MAGIC = b'SLVEND\r\n'
+_CONTAINER_VERSION = 1
+_PREAMBLE = struct.Struct('<8sH')  # magic, version
+_BLOCK = struct.Struct('<cI')  # tag, length of the json metadata that follows
+_TRAILER = struct.Struct('<cQ8s')  # b'T', offset of the index block, end magic
+_PICKLE_PROTOCOL = 5  # protocol 5 lets array data be written out-of-band, see _dumps
+_BUFFER_ALIGNMENT = 64  # out-of-band buffers start at multiples of this offset so memory mapped arrays are aligned
+_COMPRESSION_CHUNK = 1 << 20  # (de)compression streams through data in chunks of this many bytes
+_COMPRESSION_SAMPLE = 1 << 16  # compression='auto' compresses this much of a segment to see if it is compressible
+_AUTO_CODECS = ('zstd', 'lz4', 'gzip')  # compression='auto' uses the first of these that is installed
+_WRITE_BUFFER_SIZE = 8 << 20  # savevars writes through a buffer of this size
+_STORE_MIN_BYTES = 64 << 10  # savevars(store=...) keeps variables that serialize to fewer bytes in the file itself
+_UNPICKLABLE_CACHE_SIZE = 256  # number of unpicklable types that savevars remembers, least recently seen are dropped
+_FORMAT_KEYS = ('format', 'series')  # index metadata of variables saved by _dumps_native, kept in blobs too
+_MERGED_SHARDS = 'merged.dill'  # the file that mergeshards merges the shards of a sharded checkpoint into
+_EXCLUDED_NAMES = frozenset(('tmp', 'In', 'Out', 'monkeypatch'))  # notebook and test variables that are never saved
+
 
 class CustomFormatter(logging.Formatter):
     """Logging Formatter to add colors and count warning / errors"""
@@ -56,7 +95,7 @@ def get_logger(level=_LOGGING_LEVEL):
     """
     # logging.basicConfig(stream=sys.stdout, level=logging.INFO)
     logger = logging.getLogger(
-        'saveloadvars')  # tobi changed so all have same name so we can uniformly affect all of them
+        _LOGGER_NAME)  # tobi changed so all have same name so we can uniformly affect all of them
     logger.setLevel(level)
     # create console handler if this logger does not have handler yet
     if len(logger.handlers) == 0:
@@ -66,8 +105,8 @@ def get_logger(level=_LOGGING_LEVEL):
     return logger
 
 
-# https://stackoverflow.com/questions/6618795/get-locals-from-calling-namespace-in-python
-import inspect
+# the functions find the workspace with sys._getframe(1), which is what inspect.currentframe().f_back does,
+# see https://stackoverflow.com/questions/6618795/get-locals-from-calling-namespace-in-python
 
 
 def _is_var(k, v):
@@ -77,15 +116,1330 @@ def _is_var(k, v):
     :param v: its value
     :return: True if variable, False if not
     """
-    from types import ModuleType
+    if type(v) is LazyVar:  # checking its type below would load it
+        return k.startswith('_')
     isvar = k.startswith('_') \
-            or (isinstance(k, str) and (k == 'tmp' or k == 'In' or k == 'Out' or k == 'monkeypatch')) \
-            or hasattr(v, '__call__') \
-            or isinstance(v, ModuleType) \
-            or isinstance(v, logging.Logger)
+            or k in _EXCLUDED_NAMES \
+            or callable(v) \
+            or isinstance(v, _EXCLUDED_TYPES)
     return isvar
 
 
+def _select_vars(names, vars: Union[list, str, None], where='local variable'):
+    """ Central function to select the variable names matched by the `vars` argument of savevars and loadvars
+
+    :param names: the available variable names
+    :param vars: None for all names, a list of names, or a unix wildcard string
+    :param where: what the names are, for the error message
+    :returns: the list of selected names, in list order if `vars` is a list
+    :raises ValueError: if `vars` is not valid or a listed name is not available
+    """
+    log = logging.getLogger(_LOGGER_NAME)
+    if vars is None:
+        return list(names)
+    if not type(vars) is list and not type(vars) is str:
+        raise ValueError(
+            f'vars argument must be a list of strings, e.g. ["a","b"], or a wildcard string, e.g. "a*", not {vars}')
+    if type(vars) is list:
+        if not (bool(vars) and all(isinstance(elem, str) for elem in vars)):
+            raise ValueError('vars argument is a list but it must be a list of strings')
+        log.debug(f'Matching variables using list of variables {vars}')
+        for v in vars:
+            if not v in names:
+                raise ValueError(f"'{v}' is not a {where}")
+        return list(vars)
+    log.debug(f'Matching variables using wildcard expression "{vars}"')
+    return [v for v in names if fnmatch.fnmatch(v, vars)]
+
+
+def _type_name(v):
+    """ :returns: the qualified name of the type of v, e.g. 'numpy.ndarray' """
+    return _qualified_name(type(v))
+
+
+def _qualified_name(t):
+    """ :returns: the qualified name of type t, without the module for builtins """
+    return t.__qualname__ if t.__module__ == 'builtins' else f'{t.__module__}.{t.__qualname__}'
+
+
+def _describe(v):
+    """ :returns: the metadata of variable v that savevars puts into the index: its type, size, and its shape and dtype
+        if it has them, e.g. for numpy arrays and pandas objects """
+    if type(v) is LazyVar:
+        v = v.materialize()
+    meta = dict(type=_type_name(v), size=_size_of(v))
+    try:
+        shape = getattr(v, 'shape', None)
+        if isinstance(shape, tuple) and all(isinstance(n, int) for n in shape):
+            meta['shape'] = list(shape)
+        dtype = getattr(v, 'dtype', None)
+        if dtype is not None and not callable(dtype):
+            meta['dtype'] = str(dtype)
+    except Exception:  # properties of some objects raise
+        pass
+    return meta
+
+
+def _size_of(v):
+    """ :returns: the in-memory size in bytes of v, using nbytes for arrays and frames, otherwise sys.getsizeof """
+    nbytes = getattr(v, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    try:
+        return sys.getsizeof(v)
+    except TypeError:
+        return 0
+
+
+_CONTAINER_TYPES = (dict, list, tuple, set, frozenset, deque)  # _deep_size traverses the items of these
+
+
+def _deep_size(v, deadline=None):
+    """ Estimates the memory of v and of everything it refers to, counting each object once:
+    the items of python containers and the attributes of instances are traversed, while numpy arrays and
+    pandas objects count their nbytes or memory usage from _size_of instead of traversing their elements.
+
+    :param deadline: the time.perf_counter() at which to stop traversing, None for no limit
+    :returns: the size in bytes, and False if the deadline stopped the traversal, so that the size is a lower bound
+    """
+    seen = set()
+    todo = [v]
+    size = 0
+    while todo:
+        o = todo.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += _size_of(o)
+        if deadline is not None and len(seen) % 1024 == 0 and time.perf_counter() > deadline:
+            return size, False
+        if isinstance(o, dict):
+            todo.extend(o.keys())
+            todo.extend(o.values())
+        elif isinstance(o, _CONTAINER_TYPES):
+            todo.extend(o)
+        elif type(o).__module__.partition('.')[0] not in ('numpy', 'pandas') and not isinstance(o, type):
+            attributes = getattr(o, '__dict__', None)
+            if isinstance(attributes, dict):
+                todo.append(attributes)
+    return size, True
+
+
+dill = None  # the dill module once _dill() imported it
+_Pickler = None  # the dill Pickler subclass of _dumps, created by _dill()
+
+
+def _dill():
+    """ :returns: the dill module, which is imported the first time something is pickled or unpickled
+        rather than with this module, since importing it takes longer than importing everything else """
+    global dill, _Pickler
+    if dill is None:
+        import dill as module
+
+        class _Pickler(module.Pickler):
+            """ dill Pickler that hands numpy array data to the buffer_callback instead of copying it into the pickle.
+
+            dill pickles plain ndarrays with their protocol-agnostic __reduce__, which always copies the data
+            into the byte stream. Reducing them with protocol 5 instead produces PickleBuffers that refer to
+            the array memory itself.
+            """
+
+            def reducer_override(self, obj):
+                t = type(obj)
+                if t.__name__ == 'ndarray' and t.__module__ == 'numpy':
+                    return obj.__reduce_ex__(_PICKLE_PROTOCOL)
+                return NotImplemented
+
+        dill = module  # after _Pickler, so that other threads never see dill without it
+    return dill
+
+
+def _dumps(v):
+    """ Serializes one variable
+
+    :param v: the value
+    :returns: the pickle bytes, and the list of out-of-band PickleBuffers that must be stored with them
+    """
+    _dill()
+    buffers = []
+    f = io.BytesIO()
+    _Pickler(f, protocol=_PICKLE_PROTOCOL, buffer_callback=buffers.append).dump(v)
+    return f.getvalue(), buffers
+
+
+def _dumps_native(v, native=True):
+    """ Serializes one variable in a native format instead of a pickle, if it has one:
+    numpy arrays as .npy (the header is the record and the array data its buffer, so it can be memory mapped),
+    and pandas DataFrames and Series as an Arrow IPC file (or a Parquet file if native='parquet') if pyarrow
+    is installed. Values that the format cannot store exactly, e.g. object arrays or frames with object columns
+    that are not strings, have no native format.
+
+    :param v: the value
+    :param native: True or 'arrow' for Arrow IPC, or 'parquet', for frames
+    :returns: the serialized bytes as for _dumps, and the index metadata of the format,
+        or None if v has no native format
+    """
+    t = type(v)
+    if t.__name__ == 'ndarray' and t.__module__ == 'numpy':
+        if v.dtype.hasobject:
+            return None
+        import numpy
+        if not v.flags.c_contiguous and not v.flags.f_contiguous:
+            v = numpy.ascontiguousarray(v)
+        try:
+            buffer = pickle.PickleBuffer(v)
+        except (ValueError, BufferError):  # dtypes that cannot export a buffer, e.g. datetime64, are pickled
+            return None
+        header = io.BytesIO()
+        numpy.lib.format.write_array_header_1_0(header, numpy.lib.format.header_data_from_array_1_0(v))
+        return (header.getvalue(), [buffer]), dict(format='npy')
+    if t.__name__ not in ('DataFrame', 'Series') or t.__module__.partition('.')[0] != 'pandas':
+        return None
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    meta = dict(format='parquet' if native == 'parquet' else 'arrow')
+    if t.__name__ == 'Series':
+        if v.name is not None and type(v.name) not in (str, int, float):  # must round trip through the json index
+            return None
+        meta['series'] = v.name
+        v = v.to_frame(name='__series__')
+    try:
+        if v.attrs or not v.columns.is_unique or not all(_arrow_exact(values) for _, values in v.items()) \
+                or not _arrow_exact(v.index):
+            return None
+        table = pyarrow.Table.from_pandas(v)
+        sink = pyarrow.BufferOutputStream()
+        if meta['format'] == 'parquet':
+            pyarrow.parquet.write_table(table, sink)
+        else:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    except Exception as e:  # e.g. column names that Arrow cannot store
+        logging.getLogger(_LOGGER_NAME).debug(f'could not save {_type_name(v)} as {meta["format"]}, pickling it: {e}')
+        return None
+    return (b'', [pickle.PickleBuffer(sink.getvalue())]), meta
+
+
+def _arrow_exact(values):
+    """ :returns: True if the pandas column or index `values` round trips exactly through Arrow: object columns only
+        if they hold nothing but strings, since Arrow would convert other python objects """
+    if values.dtype != object:
+        return True
+    import pandas
+    return pandas.api.types.infer_dtype(values, skipna=True) in ('string', 'empty')
+
+
+def _loads(payload, buffers, entry, columns=None):
+    """ Deserializes one variable
+
+    :param payload: its decompressed serialized bytes
+    :param buffers: its decompressed out-of-band buffers
+    :param entry: its index entry, whose 'format' says if it was saved by _dumps_native
+    :param columns: None, or the list of columns to load of a DataFrame; native formats read only these columns
+    :returns: the value
+    """
+    fmt = entry.get('format')
+    if fmt is None:
+        value = _dill().loads(payload, buffers=buffers)
+        return value if columns is None else value[columns]
+    if fmt == 'npy':
+        import numpy
+        header = io.BytesIO(payload)
+        if numpy.lib.format.read_magic(header) == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(header)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(header)
+        return numpy.frombuffer(buffers[0], dtype).reshape(shape, order='F' if fortran_order else 'C')
+    if fmt not in ('arrow', 'parquet'):
+        raise ValueError(f'variable "{entry["name"]}" has unknown format {fmt}, it was saved by a newer version')
+    import pyarrow
+    source = pyarrow.py_buffer(buffers[0])
+    if columns is not None:
+        columns = [str(c) for c in columns]  # arrow field names
+    if fmt == 'parquet':
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(source), columns=columns, use_pandas_metadata=True)
+    else:
+        table = pyarrow.ipc.open_file(source).read_all()  # without copying; only the selected columns are converted
+        if columns is not None:
+            index = [c for c in table.schema.pandas_metadata['index_columns'] if isinstance(c, str)]
+            table = table.select(columns + [c for c in index if c not in columns])
+    value = table.to_pandas()
+    if 'series' in entry:
+        value = value['__series__'].rename(entry['series'])
+    return value
+
+
+# types whose instances cannot be pickled, so that savevars does not try again on every call.
+# type -> the error message, in least recently used order
+_unpicklable_types = {}
+_unpicklable_types_lock = threading.Lock()
+
+
+def _unpicklable_reason(v):
+    """ :returns: the error message if the type of v is known to be unpicklable, else None """
+    t = type(v)
+    with _unpicklable_types_lock:
+        reason = _unpicklable_types.pop(t, None)
+        if reason is not None:
+            _unpicklable_types[t] = reason  # now the most recently used
+    return reason
+
+
+def _remember_unpicklable(v, e):
+    """ remembers that the type of v cannot be pickled if the exception e from pickling v says so about the type itself,
+        e.g. "cannot pickle 'generator' object". Failures caused by something v refers to are not remembered,
+        since other instances of the type may pickle. """
+    t = type(v)
+    if str(e) != f"cannot pickle '{t.__name__}' object":
+        return
+    with _unpicklable_types_lock:
+        _unpicklable_types.pop(t, None)
+        _unpicklable_types[t] = str(e)
+        while len(_unpicklable_types) > _UNPICKLABLE_CACHE_SIZE:
+            del _unpicklable_types[next(iter(_unpicklable_types))]
+
+
+def unpicklable_types(clear: bool = False):
+    """ Shows the types that savevars found cannot be pickled in this process; variables of these types are skipped
+    without trying to pickle them again. At most 256 types are remembered, the least recently seen are forgotten.
+
+    :param clear: `True` forgets all of them, e.g. after installing a module that makes them picklable
+    :returns: dict of the qualified type names and the errors, least recently seen first, before clearing
+    """
+    with _unpicklable_types_lock:
+        types = {_qualified_name(t): reason for t, reason in _unpicklable_types.items()}
+        if clear:
+            _unpicklable_types.clear()
+    return types
+
+
+class _Lz4Compressor:
+    """ Gives lz4.frame.LZ4FrameCompressor the compress()/flush() interface of zlib compress objects """
+
+    def __init__(self):
+        import lz4.frame
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, b''
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+def _compressor(codec):
+    """ :returns: a new streaming compressor for codec, with compress(data) and flush() methods """
+    if codec == 'gzip':
+        import zlib
+        return zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes gzip framing
+    if codec == 'lzma':
+        import lzma
+        return lzma.LZMACompressor()
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    if codec == 'lz4':
+        return _Lz4Compressor()
+    raise ValueError(f'unknown compression codec "{codec}"')
+
+
+def _decompressor(codec):
+    """ :returns: a new streaming decompressor for codec, with a decompress(data) method """
+    if codec == 'gzip':
+        import zlib
+        return zlib.decompressobj(31)
+    if codec == 'lzma':
+        import lzma
+        return lzma.LZMADecompressor()
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.LZ4FrameDecompressor()
+    raise ValueError(f'unknown compression codec "{codec}", the file may have been saved by a newer version')
+
+
+def _available_codec(compression):
+    """ :returns: the codec to use for the compression argument of savevars, None for no compression
+    :raises ValueError: if the codec is unknown or its module is not installed
+    """
+    if compression is None or compression is False:
+        return None
+    modules = {'gzip': 'zlib', 'lzma': 'lzma', 'zstd': 'zstandard', 'lz4': 'lz4'}
+    if compression == 'auto':
+        return next(c for c in _AUTO_CODECS if importlib.util.find_spec(modules[c]) is not None)
+    if compression not in modules:
+        raise ValueError(f'compression must be None, "auto" or one of {list(modules)}, not "{compression}"')
+    if importlib.util.find_spec(modules[compression]) is None:
+        raise ValueError(f'compression "{compression}" needs the {modules[compression]} module; pip install it')
+    return compression
+
+
+def _compress(codec, data, sample=False):
+    """ Compresses data in chunks
+
+    :param codec: the codec
+    :param data: a bytes-like object
+    :param sample: True to first compress a sample of the data and give up if it does not compress
+    :returns: the compressed bytes, or None if they are not smaller than data
+    """
+    view = memoryview(data).cast('B')
+    if sample and len(view) > _COMPRESSION_SAMPLE:
+        c = _compressor(codec)
+        if len(c.compress(view[:_COMPRESSION_SAMPLE]) + c.flush()) > 0.9 * _COMPRESSION_SAMPLE:
+            return None
+    c = _compressor(codec)
+    out = [c.compress(view[i:i + _COMPRESSION_CHUNK]) for i in range(0, len(view), _COMPRESSION_CHUNK)]
+    out.append(c.flush())
+    out = b''.join(out)
+    return out if len(out) < len(view) else None
+
+
+def _decompress(codec, data, raw_length):
+    """ :returns: the decompression of data into a new bytearray of raw_length, decompressing it in chunks """
+    out = bytearray(raw_length)
+    view, d, pos = memoryview(out), _decompressor(codec), 0
+    data = memoryview(data).cast('B')
+    for i in range(0, len(data), _COMPRESSION_CHUNK):
+        part = d.decompress(data[i:i + _COMPRESSION_CHUNK])
+        view[pos:pos + len(part)] = part
+        pos += len(part)
+    if pos != raw_length:
+        raise ValueError(f'decompressed {pos} bytes but expected {raw_length}')
+    return out
+
+
+def _encode(serialized, codec, threshold=0, sample=False):
+    """ Compresses the pickle and each out-of-band buffer of a serialized variable separately
+
+    :param serialized: the result of _dumps
+    :param codec: the compression codec, or None
+    :param threshold: pickles and buffers smaller than this many bytes are not compressed
+    :param sample: see _compress
+    :returns: the pickle, the buffers, and the metadata for the record: 'codec' and 'raw', the uncompressed
+        length of the pickle and of each buffer, or None where it was stored uncompressed
+    """
+    payload, buffers = serialized
+    if codec is None:
+        return payload, buffers, {}
+    raw, segments = [], []
+    for segment in [payload] + [b.raw() if hasattr(b, 'raw') else b for b in buffers]:
+        segment = memoryview(segment).cast('B')
+        compressed = _compress(codec, segment, sample) if segment.nbytes >= threshold else None
+        raw.append(None if compressed is None else segment.nbytes)
+        segments.append(segment if compressed is None else compressed)
+    if all(r is None for r in raw):
+        return payload, buffers, {}
+    return segments[0], segments[1:], {'codec': codec, 'raw': raw}
+
+
+class _ContainerWriter:
+    """ Writes the container format of savevars to a binary file.
+
+    The file is the preamble (magic and version) followed by one record per variable, an index block, and
+    a fixed size trailer that points at the index block. Every block is a tag byte and the length of
+    the json metadata that follows it; a record block is followed by the serialized bytes of its variable,
+    and then by its out-of-band buffers, each padded to start at a multiple of _BUFFER_ALIGNMENT.
+    The index lists the name, offset, length, type and size of every record and the [offset, length] of its
+    buffers, so that a reader can seek straight to the variables it wants and memory map their buffers.
+    Incremental saves append records, tombstone blocks for deleted variables, and a new index and trailer;
+    only the last index counts. The index holds the crc32 of all bytes of the file before it, and the time it was written.
+    """
+
+    def __init__(self, f, index=None, crc=0):
+        """
+        :param f: the binary file to write to
+        :param index: None to start a new container, or the index entries of the variables that stay valid
+            when appending to an existing container; f must then be positioned at the end of the container
+        :param crc: the crc32 of the existing container when appending, None if it has none
+        """
+        self.f = f
+        self.crc = crc
+        if index is None:
+            self.pos = 0
+            self.index = []
+            self._write(_PREAMBLE.pack(_CONTAINER_MAGIC, _CONTAINER_VERSION))
+        else:
+            self.pos = f.tell()
+            self.index = list(index)
+
+    def _write(self, b):
+        self.f.write(b)
+        if self.crc is not None:
+            self.crc = zlib.crc32(b, self.crc)
+        self.pos += len(b)
+
+    def _block(self, tag, meta):
+        meta = json.dumps(meta, separators=(',', ':')).encode()
+        self._write(_BLOCK.pack(tag, len(meta)) + meta)
+
+    def add(self, name, payload, buffers=(), **meta):
+        """ writes the record of one variable
+
+        :param name: the variable name
+        :param payload: its serialized bytes
+        :param buffers: its out-of-band PickleBuffers (or other contiguous buffers),
+            which are written directly from the memory they refer to
+        :param meta: more metadata for the index, e.g. type and size
+        """
+        raws = [b.raw() if hasattr(b, 'raw') else memoryview(b).cast('B') for b in buffers]
+        entry = dict(name=name, length=len(payload), **meta)
+        if raws:
+            entry['buffers'] = [r.nbytes for r in raws]
+        self._block(b'R', entry)
+        entry['offset'] = self.pos
+        self._write(payload)
+        if raws:
+            entry['buffers'] = []
+            for r in raws:
+                self._write(bytes(-self.pos % _BUFFER_ALIGNMENT))
+                entry['buffers'].append([self.pos, r.nbytes])
+                self._write(r)
+        self.index.append(entry)
+
+    def delete(self, name):
+        """ writes a tombstone for a variable that was removed since the last index; the variable is not indexed """
+        self._block(b'D', {'name': name})
+
+    def close(self):
+        """ writes the index and trailer; the underlying file is not closed """
+        index_offset = self.pos
+        self.index_crc = self.crc
+        index = {'vars': self.index, 'saved': time.time()}
+        if self.crc is not None:
+            index['crc32'] = self.crc
+        self._block(b'I', index)
+        self._write(_TRAILER.pack(b'T', index_offset, _CONTAINER_END_MAGIC))
+
+
+class _ContainerReader:
+    """ Reads the index of a container written by _ContainerWriter from a seekable binary file.
+
+    If the trailer is missing, e.g. because the process died while appending to the file, the blocks are scanned
+    from the start and the last complete index is used; `recovered` is then True.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.recovered = False
+        f.seek(0)
+        magic, self.version = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != _CONTAINER_MAGIC:
+            raise ValueError('not a saveloadvars container')
+        if self.version > _CONTAINER_VERSION:
+            raise ValueError(f'container version {self.version} is newer than supported version {_CONTAINER_VERSION}')
+        f.seek(-_TRAILER.size, 2)
+        tag, self.index_offset, end_magic = _TRAILER.unpack(f.read(_TRAILER.size))
+        if tag != b'T' or end_magic != _CONTAINER_END_MAGIC:
+            self.index_offset = self._scan()
+            self.recovered = True
+            logging.getLogger(_LOGGER_NAME).warning(f'{getattr(f, "name", "file")} has no trailer, it was not '
+                                                    f'completely written; recovered its last complete index')
+        f.seek(self.index_offset)
+        index = self._block(b'I')
+        self.index = index['vars']
+        self.crc32 = index.get('crc32')
+        self.saved = index.get('saved')  # the time.time() the index was written, None for files of older versions
+
+    def _block(self, expected_tag):
+        tag, length = _BLOCK.unpack(self.f.read(_BLOCK.size))
+        if tag != expected_tag:
+            raise ValueError(f'container is corrupt, expected block {expected_tag} but found {tag}')
+        return json.loads(self.f.read(length))
+
+    def _scan(self):
+        """ :returns: the offset of the last complete index block, found by walking the blocks from the start
+        :raises ValueError: if there is none """
+        f, last_index = self.f, None
+        size = f.seek(0, 2)
+        pos = f.seek(_PREAMBLE.size)
+        while pos + _BLOCK.size <= size:
+            if f.read(1) == b'T':
+                pos = f.seek(pos + _TRAILER.size)
+                continue
+            f.seek(pos)
+            tag, length = _BLOCK.unpack(f.read(_BLOCK.size))
+            end = pos + _BLOCK.size + length
+            if tag not in (b'R', b'D', b'I') or end > size:
+                break
+            try:
+                meta = json.loads(f.read(length))
+            except ValueError:
+                break
+            if tag == b'R':
+                end += meta['length']
+                for length in meta.get('buffers', ()):
+                    end += -end % _BUFFER_ALIGNMENT + length
+            if end > size:
+                break
+            if tag == b'I':
+                last_index = pos
+            pos = f.seek(end)
+        if last_index is None:
+            raise ValueError('container is truncated or corrupt, it has no trailer and no complete index')
+        return last_index
+
+    def verify(self):
+        """ :raises ValueError: if the crc32 of the file does not match the checksum in its index """
+        if self.crc32 is None:
+            return
+        self.f.seek(0)
+        crc, remaining = 0, self.index_offset
+        while remaining > 0:
+            chunk = self.f.read(min(_COMPRESSION_CHUNK, remaining))
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            remaining -= len(chunk)
+        if crc != self.crc32:
+            raise ValueError(f'checksum of {getattr(self.f, "name", "file")} does not match, the file is corrupt')
+
+    def read(self, entry):
+        """ :returns: the serialized bytes of the variable with index entry `entry` """
+        self.f.seek(entry['offset'])
+        return self.f.read(entry['length'])
+
+    def read_buffers(self, entry, mapped=None):
+        """ Reads the out-of-band buffers of a variable
+
+        :param entry: the index entry of the variable
+        :param mapped: an mmap of the whole file to take views of, or None to read the buffers into new bytearrays
+        :returns: the list of buffers, to pass as the buffers argument of dill.loads
+        """
+        if mapped is not None:
+            view = memoryview(mapped)
+            return [view[offset:offset + length] for offset, length in entry.get('buffers', ())]
+        buffers = []
+        for offset, length in entry.get('buffers', ()):
+            buffer = bytearray(length)
+            self.f.seek(offset)
+            if self.f.readinto(buffer) != length:
+                raise ValueError(f'container is truncated, could not read buffer of variable "{entry["name"]}"')
+            buffers.append(buffer)
+        return buffers
+
+
+def _is_container(f):
+    """ :returns: True if the seekable binary file f starts with the container magic; f is rewound """
+    f.seek(0)
+    magic = f.read(len(_CONTAINER_MAGIC))
+    f.seek(0)
+    return magic == _CONTAINER_MAGIC
+
+
+def _dill_path(filename):
+    """ :returns: the Path of filename, with the .dill suffix added if it has no suffix """
+    dill_file_path = Path(filename)
+    if dill_file_path.suffix == '':  # if suffix is missing add .dill
+        dill_file_path = dill_file_path.parent / (dill_file_path.name + _DILL_EXTENSION)
+    return dill_file_path
+
+
+# incremental savevars: for each file this process saved with incremental=True,
+# the stat of the file as it was left and the fingerprints of the variables in it
+_incremental_files = {}
+_IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes, range)  # tuples may hold mutable items
+
+
+def _file_stamp(path):
+    """ :returns: a tuple that changes when the file at path is written, or None if it does not exist """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def _hash_buffers(*buffers):
+    h = hashlib.blake2b(digest_size=16)
+    for b in buffers:
+        h.update(b.raw() if hasattr(b, 'raw') else b)
+    return h.digest()
+
+
+def _crc_buffers(*buffers):
+    """ :returns: the crc32 of the buffers, which is several times faster than _hash_buffers but too weak to decide
+        that a variable need not be saved, so it only tells whosvars which variables changed """
+    crc = 0
+    for b in buffers:
+        crc = zlib.crc32(b.raw() if hasattr(b, 'raw') else b, crc)
+    return crc
+
+
+def _fingerprint(v, dumps=_dumps, digest=_hash_buffers):
+    """ Computes a fingerprint that changes when the content of a variable changes, as cheaply as possible:
+    immutable values are identified by a hash of their value (not the value itself, which would keep it alive),
+    contiguous numpy arrays by a hash of their memory, and everything else by a hash of its serialized bytes.
+
+    :param dumps: the function that serializes v, like _dumps
+    :param digest: the function that hashes buffers, _hash_buffers or _crc_buffers
+    :returns: the fingerprint, and the result of dumps(v) if it was needed for the fingerprint, else None
+    """
+    t = type(v)
+    if t in _IMMUTABLE_TYPES:
+        return (t.__name__, digest(v if t is bytes else pickle.dumps(v, _PICKLE_PROTOCOL))), None
+    if t.__name__ == 'ndarray' and t.__module__ == 'numpy' and not v.dtype.hasobject and v.flags.c_contiguous:
+        try:
+            return ('ndarray', v.dtype.str, v.shape, digest(v)), None
+        except (TypeError, ValueError, BufferError):  # some dtypes cannot export their buffer
+            pass
+    serialized = dumps(v)
+    return ('dill', digest(serialized[0], *serialized[1])), serialized
+
+
+# whosvars: the name of each variable that savevars saved in this process -> its fingerprint when it was last saved,
+# and the native argument that it was serialized with. Only hashes are kept, one per name, never the values.
+_whos_fingerprints = {}
+
+
+def _map_buffers(f, entries, use_mmap):
+    """ :returns: a copy-on-write mmap of file f if use_mmap and any of the index entries has out-of-band buffers,
+        otherwise None. ACCESS_COPY keeps the arrays writable without ever writing to the file. """
+    if use_mmap and any('buffers' in e for e in entries):
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return None
+
+
+def _read_record(reader, entry, mapped=None, use_mmap=False):
+    """ :returns: the stored pickle bytes and out-of-band buffers of the variable with index entry `entry`,
+        and the entry, see _ContainerReader.read_buffers for mapped. If the variable is a blob in a store,
+        they are read from the blob, which is memory mapped if use_mmap, and the entry is that of the blob. """
+    if 'blob' in entry:
+        return _read_blob(reader.f, entry, use_mmap)
+    return reader.read(entry), reader.read_buffers(entry, mapped), entry
+
+
+def _read_blob(f, entry, use_mmap=False):
+    """ :returns: the record of the variable with index entry `entry` in file f, whose data is a blob in a store,
+        as for _read_record """
+    with open(os.path.join(os.path.dirname(os.path.abspath(getattr(f, 'name', ''))), entry['blob']), 'rb') as f:
+        blob = _ContainerReader(f)
+        blob_entry = dict(blob.index[0], name=entry['name'])
+        return blob.read(blob_entry), blob.read_buffers(blob_entry, _map_buffers(f, [blob_entry], use_mmap)), blob_entry
+
+
+def _decompress_record(record):
+    """ :returns: the pickle bytes and out-of-band buffers of a record returned by _read_record,
+        decompressed if they were compressed """
+    payload, buffers, entry = record
+    if 'codec' in entry:
+        segments = [payload] + buffers
+        segments = [_decompress(entry['codec'], segment, raw) if raw is not None else segment
+                    for segment, raw in zip(segments, entry['raw'])]
+        payload, buffers = segments[0], segments[1:]
+    return payload, buffers
+
+
+def _decode(record):
+    """ :returns: the value of a record returned by _read_record, decompressing it if it was compressed """
+    payload, buffers = _decompress_record(record)
+    return _loads(payload, buffers, record[2])
+
+
+def _load_entry(reader, entry, mapped=None, use_mmap=False):
+    """ :returns: the value of the variable with index entry `entry`, see _read_record for mapped and use_mmap """
+    return _decode(_read_record(reader, entry, mapped, use_mmap))
+
+
+def _forkable(item):
+    """ :returns: True if variable item=(name, value) is a python object that dill pickles slowly enough to pay off
+        pickling it in a forked process, see savevars(processes=True), rather than an immutable value or an object
+        whose data numpy, pandas or pyarrow serialize without the GIL """
+    t = type(item[1])
+    return t not in _IMMUTABLE_TYPES and t.__module__.partition('.')[0] not in ('numpy', 'pandas', 'pyarrow')
+
+
+_forked_job = None  # the function and items of _map that its forked worker processes inherit
+
+
+def _call_forked(i):
+    """ runs in a forked worker process of _map: :returns: the result of the function of _map for its item i """
+    function, items = _forked_job
+    return function(items[i])
+
+
+def _map(function, items, workers=1, in_process=None, process_function=None):
+    """ Like map(), but calls function on a thread pool of `workers` threads unless workers is 1.
+    The results are in the order of items. Threads pay off only where the work releases the GIL, e.g. hashing,
+    compression, file I/O and copying array data; dill pickles and unpickles python objects in pure python,
+    holding the GIL, so that work is not sped up by threads. Items for which in_process is true are therefore
+    passed to process_function in `workers` processes instead, which are forked (where the platform can fork)
+    after items is known, so that they inherit the items rather than receiving them pickled; only the results,
+    which must be picklable, are sent back.
+    Items are taken from the iterable by the calling thread, at most two per worker ahead of the results,
+    so that streaming the items and results keeps memory bounded.
+
+    :param workers: the number of threads (and processes), None for one per CPU
+    :param in_process: None, or a function of an item that is True if it is to be processed in a process;
+        items must then be a list
+    :param process_function: the function for the items processed in a process, default function
+    """
+    global _forked_job
+    if workers == 1:
+        yield from map(function, items)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    ahead = 2 * (workers or (os.cpu_count() or 1) + 4)  # the default number of threads of ThreadPoolExecutor
+    with contextlib.ExitStack() as stack:
+        processes = None
+        if in_process is not None and any(map(in_process, items)):
+            import multiprocessing
+            if 'fork' in multiprocessing.get_all_start_methods():
+                from concurrent.futures import ProcessPoolExecutor
+                _forked_job = (process_function or function, items)
+                stack.callback(_forget_forked_job)
+                processes = stack.enter_context(ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                                                    mp_context=multiprocessing.get_context('fork')))
+                processes.submit(int).result()  # forks all processes now, before the threads below hold any locks
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        pending = deque()
+        for i, item in enumerate(items):
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+            if processes is not None and in_process(item):
+                pending.append(processes.submit(_call_forked, i))
+            else:
+                pending.append(executor.submit(function, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def _forget_forked_job():
+    global _forked_job
+    _forked_job = None
+
+
+def _memory_cost(entry, use_mmap=False):
+    """ :returns: the estimated bytes of memory that loading the variable with index entry `entry` takes: its size in
+        memory recorded by savevars (its stored size in files without it), less the array data that is memory mapped
+        if use_mmap, since mapped pages take no memory until they are written """
+    buffers = [length for _, length in entry.get('buffers', ())]
+    cost = entry.get('size', entry['length'] + sum(buffers))
+    if use_mmap and entry.get('format', 'npy') == 'npy':  # Arrow frames are converted to pandas in memory
+        raw = entry.get('raw', [None] * (1 + len(buffers)))[1:]
+        cost = max(cost - sum(length for length, r in zip(buffers, raw) if r is None), entry['length'])
+    return cost
+
+
+def _read_vars(f, vars: Union[list, str, None] = None, use_mmap=False, lazy=False, workers=1, report=None,
+               columns=None, max_memory=None, deferred=None):
+    """ Reads variables from a binary file written by savevars
+
+    :param f: the open file
+    :param vars: the variables to read, see _select_vars
+    :param use_mmap: True to back out-of-band buffers (i.e. numpy array data) by a copy-on-write memory map of the file
+    :param lazy: True to return a LazyVar for each variable instead of its value
+    :param workers: the number of threads that unpickle variables, see _map. The file is read by the calling thread.
+    :param report: a VarsReport to add the sizes and read, decompress and deserialize times of the variables to
+    :param columns: None, or dict of variable names and the list of columns of the DataFrame to load, see _loads
+    :param max_memory: None, or the bytes of memory that the loaded variables may take, see _memory_cost.
+        Variables are loaded smallest first; those that do not fit any more are returned as memory mapped LazyVars.
+    :param deferred: a dict to add the names and estimated memory of those variables to
+    :returns: dict of the variables, by name
+    :raises MemoryError: if a file saved by a version before 0.4, which cannot be loaded partially,
+        is larger than max_memory
+    """
+    columns = columns or {}
+    where = 'variable in the file'
+    if not _is_container(f):  # legacy file, a single pickled dict that must be loaded completely
+        if lazy:
+            logging.getLogger(_LOGGER_NAME).warning(f'{f.name} was saved by an older version and cannot be loaded lazily')
+        if max_memory is not None and os.fstat(f.fileno()).st_size > max_memory:
+            raise MemoryError(f'{f.name} was saved by an older version, which can only be loaded completely, '
+                              f'and it is larger than max_memory={_format_bytes(max_memory)}')
+        data = _dill().load(f)
+        return {k: data[k] if k not in columns else data[k][columns[k]] for k in _select_vars(data.keys(), vars, where)}
+    reader = _ContainerReader(f)
+    entries = {e['name']: e for e in reader.index}
+    selected = [entries[k] for k in _select_vars(entries.keys(), vars, where)]
+    if lazy:
+        path = os.path.abspath(f.name)
+        if report is not None:
+            for e in selected:
+                report.add(e)
+        return {e['name']: LazyVar(path, e, use_mmap) for e in selected}
+    order = {e['name']: i for i, e in enumerate(selected)}
+    postponed = []
+    if max_memory is not None:  # the most variables that fit, smallest first
+        budget = max_memory
+        by_cost = sorted(selected, key=lambda e: _memory_cost(e, use_mmap))
+        for i, e in enumerate(by_cost):
+            if _memory_cost(e, use_mmap) > budget:
+                selected, postponed = by_cost[:i], by_cost[i:]
+                break
+            budget -= _memory_cost(e, use_mmap)
+        else:
+            selected = by_cost
+    mapped = _map_buffers(f, selected, use_mmap)
+
+    def read(e):
+        start = time.perf_counter()
+        return _read_record(reader, e, mapped, use_mmap), time.perf_counter() - start
+
+    def decode(item):
+        record, read_seconds = item
+        start = time.perf_counter()
+        payload, buffers = _decompress_record(record)
+        decompressed = time.perf_counter()
+        value = _loads(payload, buffers, record[2], columns.get(record[2]['name']))
+        return value, record[2], dict(read=read_seconds, decompress=decompressed - start,
+                                      deserialize=time.perf_counter() - decompressed)
+
+    data = {}
+    for value, entry, seconds in _map(decode, map(read, selected), workers):
+        data[entry['name']] = value
+        if report is not None:
+            report.add(entry, **seconds)
+    path = os.path.abspath(f.name)
+    for e in postponed:
+        data[e['name']] = LazyVar(path, e, use_mmap=True)
+        if deferred is not None:
+            deferred[e['name']] = _memory_cost(e, use_mmap)
+    if max_memory is None:
+        return data
+    return dict(sorted(data.items(), key=lambda item: order[item[0]]))  # in the order of the file again
+
+
+class _StreamReader:
+    """ Reads a binary file object sequentially, counting the position and, if asked to, the crc32 of what it read """
+
+    def __init__(self, f, crc=False):
+        self.f = f
+        self.pos = 0
+        self.crc = 0 if crc else None
+
+    def _count(self, b):
+        self.pos += len(b)
+        if self.crc is not None:
+            self.crc = zlib.crc32(b, self.crc)
+
+    def tag(self):
+        """ :returns: the tag byte of the next block, b'' at the end of the stream """
+        b = self.f.read(1)
+        self._count(b)
+        return b
+
+    def read(self, n):
+        """ :returns: bytearray of the next n bytes
+        :raises ValueError: if the stream ends before """
+        b = bytearray(n)
+        view, got = memoryview(b), 0
+        readinto = getattr(self.f, 'readinto', None)
+        while got < n:
+            if readinto is not None:
+                k = readinto(view[got:])
+            else:
+                chunk = self.f.read(n - got)
+                k = len(chunk)
+                view[got:got + k] = chunk
+            if not k:
+                raise ValueError('stream ended in the middle of a block, it is truncated')
+            got += k
+        self._count(view)
+        return b
+
+    def skip(self, n):
+        """ skips n bytes, seeking past them if the stream can and no crc is needed """
+        if self.crc is None and getattr(self.f, 'seekable', lambda: False)():
+            self.f.seek(n, 1)
+            self.pos += n
+            return
+        while n > 0:
+            n -= len(self.read(min(n, _COMPRESSION_CHUNK)))
+
+
+def _read_stream(f, vars: Union[list, str, None] = None, verify=False, workers=1, report=None, columns=None,
+                 max_memory=None, deferred=None):
+    """ Reads variables sequentially from a binary file object written by savevars, e.g. a pipe, socket, BytesIO or
+    tar member, without seeking, so that only one record (per worker) is in memory at a time. The stream is read to its end.
+
+    :param f: the file object
+    :param vars: the variables to read, see _select_vars
+    :param verify: True to check the checksum of the container
+    :param workers: the number of threads that unpickle variables, see _map
+    :param report: a VarsReport to add the variables to, as for _read_vars
+    :param columns: the columns of DataFrames to load, as for _read_vars
+    :param max_memory: None, or the bytes of memory that the loaded variables may take, as for _read_vars.
+        Variables are loaded in the order of the stream; those that do not fit any more are skipped.
+    :param deferred: a dict to add the names and estimated memory of the skipped variables to
+    :returns: dict of the variables, by name
+    :raises ValueError: if the stream is truncated or corrupt
+    """
+    columns = columns or {}
+    where = 'variable in the file'
+    stream = _StreamReader(f, crc=verify)
+    magic = stream.read(len(_CONTAINER_MAGIC))
+    if magic != _CONTAINER_MAGIC:  # legacy file, a single pickled dict
+        data = _dill().loads(bytes(magic) + f.read())
+        return {k: data[k] if k not in columns else data[k][columns[k]] for k in _select_vars(data.keys(), vars, where)}
+    version, = struct.unpack('<H', stream.read(_PREAMBLE.size - len(_CONTAINER_MAGIC)))
+    if version > _CONTAINER_VERSION:
+        raise ValueError(f'container version {version} is newer than supported version {_CONTAINER_VERSION}')
+    if vars is not None and type(vars) is not list and type(vars) is not str:
+        _select_vars([], vars)  # raises the error
+    index = None  # the names in the last index, None until the stream has one
+    budget = [max_memory]
+    refused = {}  # variable name -> its estimated memory, for the variables that did not fit into max_memory
+
+    def wanted(meta):
+        name = meta['name']
+        if vars is not None and not (name in vars if type(vars) is list else fnmatch.fnmatch(name, vars)):
+            return False
+        if budget[0] is not None:
+            cost = _memory_cost(dict(meta, buffers=[[None, length] for length in meta.get('buffers', ())]))
+            if cost > budget[0]:
+                refused[name] = cost
+                return False
+            budget[0] -= cost
+        return True
+
+    def records():
+        """ yields the record of each wanted variable in the stream, and keeps the last index """
+        nonlocal index
+        while True:
+            crc = stream.crc
+            tag = stream.tag()
+            if not tag:
+                return
+            if tag == b'T':  # a trailer; appended files have more blocks after it
+                stream.read(_TRAILER.size - 1)
+                continue
+            tag, length = _BLOCK.unpack(tag + stream.read(_BLOCK.size - 1))
+            meta = json.loads(stream.read(length))
+            if tag == b'I':
+                if verify and meta.get('crc32') is not None and meta['crc32'] != crc:
+                    raise ValueError(f'checksum of {getattr(f, "name", "stream")} does not match, it is corrupt')
+                index = [e['name'] for e in meta['vars']]
+            elif tag == b'R':
+                lengths = meta.get('buffers', ())
+                if not wanted(meta):
+                    for length in lengths:
+                        meta['length'] += -(stream.pos + meta['length']) % _BUFFER_ALIGNMENT + length
+                    stream.skip(meta['length'])
+                    continue
+                payload, buffers, meta['buffers'] = stream.read(meta['length']), [], []
+                for length in lengths:
+                    stream.skip(-stream.pos % _BUFFER_ALIGNMENT)
+                    meta['buffers'].append([stream.pos, length])
+                    buffers.append(stream.read(length))
+                if not meta['buffers']:
+                    del meta['buffers']
+                yield _read_blob(f, meta) if 'blob' in meta else (payload, buffers, meta)
+            elif tag != b'D':  # tombstones are left to the index
+                raise ValueError(f'container is corrupt, found unknown block {tag}')
+
+    def decode(record):
+        start = time.perf_counter()
+        payload, buffers = _decompress_record(record)
+        decompressed = time.perf_counter()
+        return _loads(payload, buffers, record[2], columns.get(record[2]['name'])), record[2], \
+            dict(decompress=decompressed - start, deserialize=time.perf_counter() - decompressed)
+
+    data, entries = {}, {}
+    for value, entry, seconds in _map(decode, records(), workers):
+        data[entry['name']] = value  # a later record of an appended file replaces an earlier one
+        entries[entry['name']] = entry, seconds
+    if index is None:
+        raise ValueError(f'{getattr(f, "name", "stream")} ended before its index, it is truncated')
+    selected = [k for k in _select_vars(index, vars, where) if k not in refused]
+    if deferred is not None:
+        deferred.update(refused)
+    if report is not None:
+        for k in selected:
+            report.add(entries[k][0], **entries[k][1])
+    return {k: data[k] for k in selected}
+
+
+def _format_bytes(n):
+    """ :returns: n bytes as a short human readable string, e.g. '1.5 MB' """
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if abs(n) < 1000 or unit == 'TB':
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1000
+
+
+class VarsReport:
+    """ Timing and size report of one savevars or loadvars call, returned by them with `profile=True`.
+
+    `variables` maps the name of each saved or loaded variable to a dict of its 'type', its 'size' in memory,
+    the 'stored' bytes it takes in the file, its 'raw' bytes before compression, their 'ratio', and its times in seconds:
+    'serialize' and 'compress' for savevars, 'read', 'decompress' and 'deserialize' for loadvars.
+    `phases` maps the phases of the call to their wall time in seconds, e.g. 'select' (finding the variables to save),
+    'serialize', 'write' and 'total'. `skipped` maps variables that were not saved to the reason, and `deferred` the
+    variables that loadvars(max_memory=...) did not load to their estimated memory.
+    With savevars(store=...), 'stored' is 0 for variables whose blob was already in the store.
+    str() of the report is a table of the slowest variables.
+    """
+    _TIMINGS = {'savevars': ('serialize', 'compress'), 'loadvars': ('read', 'decompress', 'deserialize')}
+
+    def __init__(self, operation, path):
+        """
+        :param operation: 'savevars' or 'loadvars'
+        :param path: the file
+        """
+        self.operation = operation
+        self.path = path
+        self.variables = {}
+        self.phases = {}
+        self.skipped = {}
+        self.deferred = {}
+
+    @property
+    def timings(self):
+        """ the names of the per-variable times of this operation """
+        return VarsReport._TIMINGS[self.operation]
+
+    def add(self, entry, **seconds):
+        """ adds a variable
+
+        :param entry: the container index entry of the variable, which has its sizes
+        :param seconds: its times by name, see timings
+        """
+        segments = [entry['length']] + [length for _, length in entry.get('buffers', ())]
+        stored = sum(segments)
+        raw = sum(r if r is not None else s for s, r in zip(segments, entry.get('raw', [None] * len(segments))))
+        self.variables[entry['name']] = dict(type=entry.get('type', '?'), size=entry.get('size', 0), stored=stored,
+                                             raw=raw, ratio=raw / stored if stored else 1.0, **seconds)
+
+    def slowest(self, n=10):
+        """ :returns: list of the (name, dict) of the n variables that took the most time, slowest first """
+        return sorted(self.variables.items(), key=lambda item: -sum(item[1].get(t, 0) for t in self.timings))[:n]
+
+    def __str__(self):
+        stored = sum(v['stored'] for v in self.variables.values())
+        phases = ', '.join(f'{k} {v:.3f} s' for k, v in self.phases.items() if k != 'total')
+        lines = [f'{self.operation} {self.path}: {len(self.variables)} variables, {_format_bytes(stored)} '
+                 f'in {self.phases.get("total", 0):.3f} s ({phases})',
+                 f'  {"variable":20} {"type":24} {"size":>9} {"stored":>9} {"ratio":>7}'
+                 + ''.join(f' {t:>11}' for t in self.timings)]
+        for name, v in self.slowest():
+            lines.append(f'  {name:20} {v["type"]:24} {_format_bytes(v["size"]):>9} {_format_bytes(v["stored"]):>9} '
+                         f'{v["ratio"]:7.1f}' + ''.join(f' {v.get(t, 0):9.3f} s' for t in self.timings))
+        if len(self.variables) > 10:
+            lines.append(f'  ... and {len(self.variables) - 10} faster variables')
+        if self.skipped:
+            lines.append('  skipped: ' + ', '.join(f'{k} ({reason})' for k, reason in self.skipped.items()))
+        if self.deferred:
+            lines.append('  deferred: ' + ', '.join(f'{k} ({_format_bytes(n)})' for k, n in self.deferred.items()))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return f'<VarsReport {self.operation} {self.path}: {len(self.variables)} variables in ' \
+               f'{self.phases.get("total", 0):.3f} s>'
+
+
+def _emit_report(report, profile, log):
+    """ logs the report and passes it to the profile callback, if profile is callable """
+    log.info(report)
+    if callable(profile):
+        try:
+            profile(report)
+        except Exception as e:
+            log.warning(f'profile callback {profile} raised {e!r}')
+
+
+class LazyVar:
+    """ Placeholder that loadvars(lazy=True) puts into the workspace instead of the value of a variable.
+
+    The value is read from the file the first time the variable is used: any attribute access, operator,
+    indexing, iteration or conversion loads it, after which the LazyVar forwards everything to it.
+    isinstance() checks use the type in the index if its module is imported, and load the value otherwise.
+    Its repr, and its display in IPython and Jupyter, show the type and size of the variable without loading it.
+    Use `x = x.materialize()` to replace the placeholder by the value itself.
+    """
+    __slots__ = ('_lazyvar_path', '_lazyvar_entry', '_lazyvar_mmap', '_lazyvar_value', '__weakref__')
+    _NOT_LOADED = object()
+
+    def __init__(self, path, entry, use_mmap=False):
+        """
+        :param path: the absolute path of the container file
+        :param entry: the index entry of the variable in the file
+        :param use_mmap: True to memory map the out-of-band buffers of the variable, see loadvars
+        """
+        object.__setattr__(self, '_lazyvar_path', path)
+        object.__setattr__(self, '_lazyvar_entry', entry)
+        object.__setattr__(self, '_lazyvar_mmap', use_mmap)
+        object.__setattr__(self, '_lazyvar_value', LazyVar._NOT_LOADED)
+
+    def materialize(self):
+        """ Loads the variable from its file if it is not loaded yet
+
+        :returns: the value of the variable
+        :raises ValueError: if the file was overwritten with different contents since loadvars
+        """
+        value = self._lazyvar_value
+        if value is LazyVar._NOT_LOADED:
+            entry = self._lazyvar_entry
+            with open(self._lazyvar_path, 'rb') as f:
+                reader = _ContainerReader(f)
+                if entry not in reader.index:
+                    raise ValueError(f'{self._lazyvar_path} changed since variable "{entry["name"]}" was loaded lazily')
+                value = _load_entry(reader, entry, _map_buffers(f, [entry], self._lazyvar_mmap), self._lazyvar_mmap)
+            object.__setattr__(self, '_lazyvar_value', value)
+        return value
+
+    def __repr__(self):
+        if self._lazyvar_value is not LazyVar._NOT_LOADED:
+            return repr(self._lazyvar_value)
+        entry = self._lazyvar_entry
+        return f'<LazyVar {entry["name"]}: {entry.get("type", "?")}, {_format_bytes(entry.get("size", 0))} ' \
+               f'in {self._lazyvar_path}, not loaded yet>'
+
+    def __getattr__(self, name):
+        if name.startswith(('_ipython_', '_repr_')) and self._lazyvar_value is LazyVar._NOT_LOADED:
+            raise AttributeError(name)  # IPython probes these to display the variable, which must not load it
+        return getattr(self.materialize(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.materialize(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self.materialize(), name)
+
+    def __dir__(self):
+        return dir(self.materialize())
+
+    @property
+    def __class__(self):  # makes isinstance() see the type of the value
+        value = self._lazyvar_value
+        if value is LazyVar._NOT_LOADED:
+            t = _imported_type(self._lazyvar_entry.get('type', ''))
+            if t is not None:
+                return t
+            value = self.materialize()
+        return value.__class__
+
+    def _repr_pretty_(self, p, cycle):
+        """ IPython pretty printing: the placeholder while the variable is not loaded, otherwise the value """
+        if self._lazyvar_value is LazyVar._NOT_LOADED:
+            p.text(repr(self))
+        else:
+            p.pretty(self._lazyvar_value)
+
+    def _ipython_display_(self):
+        """ IPython and Jupyter display: the placeholder while the variable is not loaded, otherwise the value """
+        from IPython.display import display
+        if self._lazyvar_value is LazyVar._NOT_LOADED:
+            display({'text/plain': repr(self)}, raw=True)
+        else:
+            display(self._lazyvar_value)
+
+    def __reduce_ex__(self, protocol):  # pickles as the value
+        return self.materialize().__reduce_ex__(protocol)
+
+
+def _imported_type(name):
+    """ :returns: the type with qualified name `name` from _qualified_name if its module is imported, else None.
+        Types of __main__ are not returned, since dill recreates them when it loads their instances. """
+    parts = name.split('.')
+    module, attributes = 'builtins', parts
+    for i in range(len(parts) - 1, 0, -1):
+        if '.'.join(parts[:i]) in sys.modules:
+            module, attributes = '.'.join(parts[:i]), parts[i:]
+            break
+    if module == '__main__':
+        return None
+    t = sys.modules.get(module)
+    for attribute in attributes:
+        t = getattr(t, attribute, None)
+    return t if isinstance(t, type) else None
+
+
+def _as_array(v, *args, **kwargs):
+    import numpy
+    return numpy.asarray(v, *args, **kwargs)
+
+
+def _lazyvar_forward(name, function, reflected=False):
+    """ :returns: a LazyVar method that applies function to the loaded value (as its right operand if reflected) """
+    if reflected:
+        def method(self, other):
+            return function(other, self.materialize())
+    else:
+        def method(self, *args, **kwargs):
+            return function(self.materialize(), *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+for _name, _function in [('__str__', str), ('__bytes__', bytes), ('__format__', format), ('__bool__', bool),
+                         ('__hash__', hash), ('__len__', len), ('__iter__', iter), ('__reversed__', reversed),
+                         ('__contains__', lambda v, item: item in v), ('__getitem__', operator.getitem),
+                         ('__setitem__', operator.setitem), ('__delitem__', operator.delitem),
+                         ('__int__', int), ('__float__', float), ('__complex__', complex), ('__index__', operator.index),
+                         ('__round__', round), ('__neg__', operator.neg), ('__pos__', operator.pos),
+                         ('__abs__', abs), ('__invert__', operator.invert), ('__array__', _as_array),
+                         ('__eq__', operator.eq), ('__ne__', operator.ne), ('__lt__', operator.lt),
+                         ('__le__', operator.le), ('__gt__', operator.gt), ('__ge__', operator.ge),
+                         ('__divmod__', divmod)]:
+    setattr(LazyVar, _name, _lazyvar_forward(_name, _function))
+setattr(LazyVar, '__rdivmod__', _lazyvar_forward('__rdivmod__', divmod, reflected=True))
+for _op in ('add', 'sub', 'mul', 'matmul', 'truediv', 'floordiv', 'mod', 'pow', 'lshift', 'rshift', 'and', 'or', 'xor'):
+    _function = getattr(operator, _op if _op not in ('and', 'or') else _op + '_')
+    setattr(LazyVar, f'__{_op}__', _lazyvar_forward(f'__{_op}__', _function))
+    setattr(LazyVar, f'__r{_op}__', _lazyvar_forward(f'__r{_op}__', _function, reflected=True))
+    setattr(LazyVar, f'__i{_op}__', _lazyvar_forward(f'__i{_op}__', getattr(operator, f'i{_op}')))
+del _name, _function, _op
+
+
+class VarsPolicy:
+    """ Decisions that savevars and loadvars make without asking: whether to overwrite an existing file, which existing
+    variables to overwrite, and which files are trusted to be unpickled. With a policy they never prompt, sleep or
+    read stdin, so they can run from scripts, parameter sweeps and background threads.
+
+    Example: `VarsPolicy(overwrite={'results*': True, '*': False}, trusted=['/data/runs/*'])`
+    """
+
+    def __init__(self, overwrite: Union[bool, dict] = False, overwrite_files: bool = True,
+                 trusted: Union[bool, str, list] = False):
+        """
+        :param overwrite: whether loadvars overwrites existing variables: `True` or `False` for all of them, or a dict
+            of unix style wildcards of variable names and `True` or `False`; the first wildcard that matches a name
+            decides, and variables that match none are not overwritten
+        :param overwrite_files: whether savevars overwrites an existing file
+        :param trusted: the files that loadvars may unpickle without the warning about unpickling: `True` for all files,
+            or unix style wildcards (a string or list of them) of absolute paths, e.g. '/data/runs/*'. loadvars raises
+            PermissionError for other files.
+        """
+        self.overwrite = overwrite
+        self.overwrite_files = overwrite_files
+        self.trusted = [trusted] if type(trusted) is str else trusted
+
+    def overwritten(self, names):
+        """ :returns: the set of the existing variable names that loadvars overwrites, decided in one pass """
+        if type(self.overwrite) is bool:
+            return set(names) if self.overwrite else set()
+        overwritten = set()
+        for name in names:
+            for pattern, decision in self.overwrite.items():
+                if fnmatch.fnmatchcase(name, pattern):
+                    if decision:
+                        overwritten.add(name)
+                    break
+        return overwritten
+
+    def trusts(self, path):
+        """ :returns: True if the file at path may be unpickled; file objects without a name are only trusted by
+            `trusted=True` """
+        if self.trusted is True:
+            return True
+        if not self.trusted or not isinstance(path, (str, os.PathLike)):
+            return False
+        path = os.path.abspath(path)
+        return any(fnmatch.fnmatch(path, os.path.abspath(pattern)) for pattern in self.trusted)
+
+    def __repr__(self):
+        return f'VarsPolicy(overwrite={self.overwrite!r}, overwrite_files={self.overwrite_files!r}, ' \
+               f'trusted={self.trusted!r})'
+
+
 def printvars(logging_level=_LOGGING_LEVEL):
     """ prints local variables, similar to %who in ipython jupyter notebook.
 
@@ -95,7 +1449,7 @@ def printvars(logging_level=_LOGGING_LEVEL):
     locals = None
     log = get_logger(logging_level)
 
-    frame = inspect.currentframe().f_back
+    frame = sys._getframe(1)
     try:
         locals = frame.f_locals
     finally:
@@ -104,23 +1458,137 @@ def printvars(logging_level=_LOGGING_LEVEL):
         print('No variables found in this workspace')
         return ''
     print('Non-Jupyter-notebook variables in this workspace: ', end='')
-    s = ''
-    for k, v in locals.items():
-        if _is_var(k, v):
-            continue
-        s += k + ','
-    s = s[:-1]  # remove last comma
+    s = ','.join(k for k, v in locals.items() if not _is_var(k, v))
     print(s)
     return s
 
 
+def whosvars(vars: Union[list, str, None] = None, time_budget: Optional[float] = 1.0,
+             namespace: Optional[dict] = None, logging_level=_LOGGING_LEVEL):
+    """ prints the variables that savevars would save with what they cost, similar to %whos in ipython:
+    their type, shape and dtype, shallow size (sys.getsizeof), estimated deep size in memory,
+    estimated size in the file, and whether they changed since savevars last saved them in this process,
+    largest first. Use it to decide which variables to leave out of checkpoints.
+
+    Changes are found with the fingerprint of each variable that savevars keeps, one hash per name and never the
+    value: incremental savevars keeps the fingerprints that it compares anyway, and other saves a crc32 of the bytes
+    that they write, or of the data of arrays.
+    Each variable is serialized at most once, which gives both its size in the file and its fingerprint;
+    arrays are serialized without copying their data, and their deep size is their nbytes. Deep sizes are
+    estimated first, then the variables are serialized from the smallest to the largest, until time_budget
+    seconds are spent. The variables left out are shown with the sizes that need no traversal or serialization.
+
+    :param vars: a list of names or a unix style wildcard string of the variables to show, as for savevars
+    :param time_budget: the seconds to spend on deep sizes, serialized sizes and changes, None for no limit
+    :param namespace: a dict of variables to show instead of the workspace of the caller
+    :param logging_level: set a different logging level (for testing)
+    :returns: list with a dict for each variable: its 'name', 'type', 'shape' and 'dtype' if it has them,
+        'size' (shallow), 'deep_size', 'complete' (False if 'deep_size' is only a lower bound), 'serialized'
+        (None if it could not be pickled or was not estimated) and 'changed' (None if savevars did not save it in
+        this process or it was not checked)
+    """
+    get_logger(logging_level)
+    locals = namespace
+    if locals is None:
+        frame = sys._getframe(1)
+        try:
+            locals = frame.f_locals
+        finally:
+            del frame
+    candidates = {k: v for k, v in locals.items() if not _is_var(k, v)}
+    if vars is not None:
+        candidates = {k: candidates[k] for k in _select_vars(candidates.keys(), vars)}
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+
+    def over_budget():
+        return deadline is not None and time.perf_counter() > deadline
+
+    saved = {k: _whos_fingerprints[k] for k in candidates if k in _whos_fingerprints}  # name -> (fingerprint, native)
+
+    def changed(k, v, dumps=_dumps):
+        """ :returns: whether v differs from variable k when it was saved, hashed as savevars hashed it """
+        fingerprint = saved[k][0]
+        digest = _hash_buffers if isinstance(fingerprint[-1], bytes) else _crc_buffers
+        return fingerprint != _fingerprint(v, dumps, digest)[0]
+
+    variables = []
+    pending = []  # (info, value) of the variables whose deep size and serialization take time
+    for k, v in candidates.items():
+        if type(v) is LazyVar and v._lazyvar_value is LazyVar._NOT_LOADED:  # shown from its index entry
+            e = v._lazyvar_entry
+            variables.append(dict(name=k, type=f'LazyVar({e.get("type", "?")})', size=sys.getsizeof(v),
+                                  deep_size=e.get('size', 0), complete=True, serialized=None, changed=None))
+            continue
+        if type(v) is LazyVar:
+            v = v.materialize()
+        info = dict(name=k, **{key: value for key, value in _describe(v).items() if key != 'size'})
+        info.update(size=sys.getsizeof(v, 0), deep_size=0, complete=True, serialized=None, changed=None)
+        variables.append(info)
+        if type(v) in _IMMUTABLE_TYPES:  # dill pickles them as pickle does, which is much faster
+            info['deep_size'] = info['size']
+            info['serialized'] = len(pickle.dumps(v, _PICKLE_PROTOCOL))
+            if k in saved:
+                info['changed'] = changed(k, v)
+        else:
+            pending.append((info, v))
+    for info, v in pending:
+        if over_budget():
+            info['deep_size'] = _size_of(v)
+            info['complete'] = type(v).__module__.partition('.')[0] in ('numpy', 'pandas')
+        else:
+            info['deep_size'], info['complete'] = _deep_size(v, deadline)
+    for info, v in sorted(pending, key=lambda item: item[0]['deep_size']):
+        if over_budget():
+            break
+        if _unpicklable_reason(v) is not None:
+            continue
+        native = saved[info['name']][1] if info['name'] in saved else False
+        try:
+            native_serialized = _dumps_native(v, native) if native else None
+            serialized = _dumps(v) if native_serialized is None else native_serialized[0]
+        except Exception as e:
+            _remember_unpicklable(v, e)
+            continue
+        info['serialized'] = _serialized_size(serialized)
+        if info['name'] in saved:  # hashes the serialized bytes, or the memory of arrays
+            info['changed'] = changed(info['name'], v, lambda v: serialized)
+    variables.sort(key=lambda info: info['deep_size'], reverse=True)
+    print(_format_whos(variables, saved, over_budget()))
+    return variables
+
+
+def _format_whos(variables, saved, over_budget=False):
+    """ :returns: the result of whosvars as a table """
+    deep = sum(v['deep_size'] for v in variables)
+    serialized = sum(v['serialized'] or 0 for v in variables)
+    lines = [f'{len(variables)} variables, {_format_bytes(deep)} in memory, {_format_bytes(serialized)} to save'
+             + (', time budget exceeded: sizes marked > are lower bounds and ? were not estimated'
+                if over_budget else '')]
+    lines.append(f'  {"name":20} {"type":24} {"shape":>14} {"dtype":>9} {"size":>9} {"deep":>10} {"saves":>9} changed')
+    for v in variables:
+        shape = 'x'.join(str(n) for n in v['shape']) if 'shape' in v else ''
+        deep = ('' if v['complete'] else '>') + _format_bytes(v['deep_size'])
+        serialized = '?' if v['serialized'] is None else _format_bytes(v['serialized'])
+        changed = {True: 'yes', False: 'no', None: '?' if v['name'] in saved else ''}[v['changed']]
+        lines.append(f'  {v["name"]:20} {v["type"]:24} {shape:>14} {v.get("dtype", ""):>9} '
+                     f'{_format_bytes(v["size"]):>9} {deep:>10} {serialized:>9} {changed}')
+    return '\n'.join(lines)
+
+
 def savevars(filename: str = _DEFAULT_FILENAME, vars: Union[list, str, None] = None,
-             overwrite: Union[bool, str] = 'prompt', logging_level=_LOGGING_LEVEL):
+             overwrite: Union[bool, str] = 'prompt', incremental: bool = False, workers: Optional[int] = 1,
+             compression: Optional[str] = None, compression_threshold: int = 4096, background: bool = False,
+             keep: int = 0, profile: Union[bool, Callable] = False, store: Optional[str] = None,
+             native: Union[bool, str] = False, namespace: Optional[dict] = None, policy: Optional[VarsPolicy] = None,
+             processes: bool = False, logging_level=_LOGGING_LEVEL):
     """
     saves all local variables to a file with dill
     
     :param filename: the name of the file. The suffix .dill is added if there is not a suffix already.
         A default filename is used with no arguments.
+        It can also be a binary file object opened for writing, e.g. a pipe, socket, io.BytesIO or an open file,
+        which is written sequentially, each variable as soon as it is serialized, so that only one variable
+        (per worker) is held in memory. It is not closed. incremental, keep and store need a filename.
     :param vars: a list of string names of variables to save.
         If `vars=None` (default), all local variables are saved.
         If `vars` is a single string,
@@ -129,135 +1597,982 @@ def savevars(filename: str = _DEFAULT_FILENAME, vars: Union[list, str, None] = N
         all variables starting with `a`. If `vars` is a list of strings, then these variables are saved.
     :param overwrite: 'prompt' (default) prompts for overwrite of existing file,
         'yes' or `True` overwrites, 'no'  or `False` does not overwrite.
+    :param incremental: `True` appends only the variables that changed since the last incremental savevars
+        to the same file in this process, and tombstones for variables that were removed.
+        Unchanged variables are detected by fingerprints: immutable values by a hash of their value, numpy arrays
+        by a hash of their data, and other values by a hash of their serialized bytes, so unchanged variables are
+        never written.
+        The first incremental save of a file, or one after the file was written by anything else, saves everything.
+        Use compactvars() to reclaim the space of superseded records.
+    :param workers: the number of threads that serialize variables concurrently, None for one per CPU.
+        The file holds the same records in the same order as with `workers=1`. Threads speed up compression,
+        hashing, writing and the data of numpy arrays and pandas frames, but not dill pickling python objects,
+        which holds the GIL; see processes.
+    :param compression: None (default) for no compression, or the codec that compresses each variable:
+        'gzip' or 'lzma' from the standard library, 'zstd' if zstandard is installed, 'lz4' if lz4 is installed,
+        or 'auto' for the fastest installed one, which also skips data that does not compress, e.g. random numbers.
+        Data that does not get smaller is stored uncompressed. loadvars decompresses automatically.
+    :param compression_threshold: pickles and array buffers smaller than this many bytes are not compressed.
+    :param background: `True` returns a SaveHandle as soon as the variables are serialized, and compresses and writes
+        them to the file on a background thread, so the notebook can continue while the file is written.
+        The data of writable numpy arrays is copied, so changing them afterwards does not change what is saved.
+        Background saves are written one after the other; savevars and loadvars of the same file wait for them.
+    :param keep: the number of previous versions of the file to keep, as filename.1 (the newest), filename.2, ...
+        The file is always written to a temporary file that replaces it only when it is completely written, its bytes
+        match their checksum and it is synced to disk, so a crash while saving never destroys the existing file.
+        Incremental saves append in place instead, writing the new index only after the new records are on disk.
+    :param profile: `True` measures the serialize and compress time and stored size of each variable and the time of
+        each phase of the save, logs the slowest variables and returns the VarsReport.
+        A function is called with the VarsReport (on the background thread for background saves).
+    :param store: a directory to use as a content-addressed store of variables that are shared by many files.
+        Each variable that serializes to 64 kB or more is stored once in the store as a blob named by the hash of its
+        serialized bytes, and the file only refers to it, so checkpoints that hold the same large arrays or tables
+        share one copy, and variables whose blob already exists are not compressed or written again.
+        loadvars finds the blobs by themselves. Use gcvars(store) to delete blobs that no file refers to any more.
+    :param native: `True` saves numpy arrays in .npy format and pandas DataFrames and Series as Arrow IPC files
+        (if pyarrow is installed) inside the file instead of pickling them, 'parquet' saves frames as Parquet,
+        which is compressed and slower. These load without unpickling, arrays can be memory mapped, and loadvars can
+        read only some columns of the frames. Values that the formats cannot store exactly, e.g. object arrays or
+        frames with columns of python objects, and all other variables are pickled with dill as usual.
+    :param namespace: a dict of variables to save instead of the local variables of the caller, e.g. the results of
+        a function or a worker process. See saveshard to save many of them into one sharded checkpoint.
+    :param policy: a VarsPolicy that decides whether an existing file is overwritten instead of `overwrite`,
+        without prompting
+    :param processes: `True` pickles python objects, e.g. lists, dicts and class instances, in `workers` forked
+        processes instead of threads, so that dill uses that many cores. The processes inherit the variables when
+        they are forked and send back only the pickled bytes. numpy arrays, pandas objects and immutable values stay
+        on threads, since shipping their data back would cost more than it saves. On platforms that cannot fork,
+        e.g. Windows, everything is serialized on threads. Forking while other threads of the program hold locks
+        may deadlock the processes, so only use it from a program that does not run threads of its own.
     :param: logging_level: set a different logging level (for testing)
+
+    :returns: None, a VarsReport if `profile` is set, or a SaveHandle if `background=True`,
+        whose `report` is the VarsReport once the file is written
+    :raises OSError: if the file cannot be written; the existing file is then unchanged
     """
     log = get_logger(logging_level)
+    start = time.perf_counter()
 
-    import inspect, dill
-    locals = None
-    frame = inspect.currentframe().f_back
-    try:
-        locals = frame.f_locals
-    finally:
-        del frame
+    locals = namespace
+    if locals is None:
+        frame = sys._getframe(1)
+        try:
+            locals = frame.f_locals
+        finally:
+            del frame
     if locals is None:
         log.warning('found zero variables to save')
         return
     if not vars is None:
-        if not type(vars) is list and not type(vars) is str:
-            raise ValueError(
-                'vars argument must be a list of strings, e.g. ["a","b"], or a wildcard string, e.g. "a*", not {vars}')
-
-        vars_to_save = dict()  # a temp dict to save the ones we really want to save
-        if type(vars) is list:
-            def is_list_of_strings(lst):
-                return bool(lst) and not isinstance(lst, str) and all(isinstance(elem, str) for elem in lst)
-
-            if not is_list_of_strings(vars):
-                raise ValueError('vars argument is a list but it must be a list of strings')
-
-            log.debug(f'Matching variables to save using list of variables {vars}')
-            # vars is a list of string names of vars
-            for v in vars:
-                if not v in locals.keys():
-                    raise ValueError(f"'{v}' is not a local variable")
-                else:
-                    vars_to_save[v] = locals[v]
-            locals = vars_to_save
-        elif type(vars) is str:
-            log.debug(f'Matching variables to save using wildcard expression "{vars}"')
-            for v in locals:
-                if fnmatch.fnmatch(v, vars):
-                    log.debug(f'matched local variable "v" to wildcard "{vars}"')
-                    vars_to_save[v] = locals[v]
+        vars_to_save = _select_vars(locals.keys(), vars)
         if len(vars_to_save) == 0:
             log.warning(f'Cancelling - no local variables matched vars={vars}')
             return
-        locals = vars_to_save
+        locals = {k: locals[k] for k in vars_to_save}
 
-    data = {}
+    if filename is None:
+        log.error('you must supply a filename')
+        return
+    stream = filename if hasattr(filename, 'write') else None
+    if stream is not None:
+        if incremental or keep or store is not None:
+            raise ValueError('incremental, keep and store need a filename, not a file object')
+        dill_file_path = getattr(stream, 'name', f'<{type(stream).__name__}>')  # for the messages
+    else:
+        dill_file_path = _dill_path(filename)
+    codec = _available_codec(compression)
+    if native not in (False, True, 'arrow', 'parquet'):
+        raise ValueError(f"native must be True, False, 'arrow' or 'parquet', not {native!r}")
+    # the fingerprints of the variables in the file if we can append to it, otherwise None
+    saved_fingerprints = None
+    if stream is None:  # before the stamp lookup, so that it sees the file a background save is writing finished
+        _wait_for_background(dill_file_path)
+    if incremental:
+        key = str(dill_file_path.resolve())
+        stamp, saved_fingerprints = _incremental_files.get(key, (None, None))
+        if stamp is None or stamp != _file_stamp(dill_file_path):
+            saved_fingerprints = None
+    elif stream is None:
+        _incremental_files.pop(str(dill_file_path.resolve()), None)
+    report = VarsReport('savevars', dill_file_path) if profile else None
+    data = {}  # variable name -> its index metadata, for the variables that are saved
     could_not_pickle = []
+    fingerprints = {}
+    unchanged = []
+    seconds = {}  # variable name -> its serialize and compress times
+    blobs = {}  # variable name -> the key of its blob in the store
+    existing_blobs = set()  # keys of blobs that were in the store already
+
+    def encode(serialized):
+        """ :returns: the _encode() result and the seconds it took """
+        start = time.perf_counter()
+        return _encode(serialized, codec, compression_threshold, sample=compression == 'auto'), \
+            time.perf_counter() - start
+
+    def serialize(item):
+        """ :returns: the _encode() result of a variable (the _snapshot() result for background saves),
+            None if it is unchanged, or the exception if it failed; its fingerprint, a crc32 one for whosvars
+            unless incremental;
+            the key of its blob if it goes to the store; its serialize and compress times;
+            and the index metadata of its native format, if it has one """
+        k, v = item
+        start = time.perf_counter()
+        reason = _unpicklable_reason(v)
+        if reason is not None:
+            return TypeError(reason), None, None, None, None
+        fmt = {}
+
+        def dumps(v):
+            native_serialized = _dumps_native(v, native) if native else None
+            if native_serialized is None:
+                return _dumps(v)
+            fmt.update(native_serialized[1])
+            return native_serialized[0]
 
-    from types import ModuleType
-    s = ''
-    for k, v in locals.items():
-        # don't try to pickle any objects that we don't want from notebook and anything that doesn't pickle
-        if _is_var(k, v):
-            continue
         try:
-            if not dill.pickles(v):
+            # serialize each variable exactly once; a failure here is what used to be the dill.pickles() probe
+            fingerprint = serialized = None
+            if incremental:
+                fingerprint, serialized = _fingerprint(v, dumps)
+                if saved_fingerprints is not None and k in saved_fingerprints \
+                        and saved_fingerprints[k] == fingerprint:
+                    return None, fingerprint, None, None, None
+            if serialized is None:
+                serialized = dumps(v)
+            if fingerprint is None:  # hashes the bytes that are saved anyway, or the memory of arrays
+                fingerprint = _fingerprint(v, lambda v: serialized, _crc_buffers)[0]
+        except Exception as e:
+            _remember_unpicklable(v, e)
+            return e, None, None, None, None
+        blob = None
+        if store is not None and _serialized_size(serialized) >= _STORE_MIN_BYTES:
+            if incremental and fingerprint[0] == 'dill':  # already the hash of the serialized bytes
+                blob = fingerprint[1].hex()
+            else:
+                blob = _hash_buffers(serialized[0], *serialized[1]).hex()
+            if _blob_path(store, blob).exists():  # nothing to compress or write
+                times = dict(serialize=time.perf_counter() - start, compress=0)
+                return ((b'', []) if background else (b'', [], {})), fingerprint, blob, times, fmt
+        if background:  # compressed when it is written
+            times = dict(serialize=time.perf_counter() - start, compress=0)
+            return _snapshot(serialized), fingerprint, blob, times, fmt
+        serialize_seconds = time.perf_counter() - start
+        encoded, compress_seconds = encode(serialized)
+        return encoded, fingerprint, blob, dict(serialize=serialize_seconds, compress=compress_seconds), fmt
+
+    def serialize_in_process(item):
+        """ serialize() in a forked process of _map: the same result, but picklable to send it back """
+        serialized, *rest = serialize(item)
+        if isinstance(serialized, Exception):  # it may not pickle, only its message is used
+            serialized = TypeError(str(serialized))
+        elif serialized is not None:
+            payload, buffers, *codec_meta = serialized
+            serialized = (bytes(payload), [bytes(b.raw()) if isinstance(b, pickle.PickleBuffer) else bytes(b)
+                                           for b in buffers], *codec_meta)
+        return (serialized, *rest)
+
+    # don't try to pickle any objects that we don't want from notebook and anything that doesn't pickle
+    phase = time.perf_counter()
+    candidates = [(k, v) for k, v in locals.items() if not _is_var(k, v) and v is not stream]
+    if report is not None:
+        report.phases['select'], phase = time.perf_counter() - phase, time.perf_counter()
+    s = ''
+
+    def serialized_vars():
+        """ serializes the variables, keeping track of those that are not saved,
+            and yields the name, serialized value and index metadata of each variable that is saved """
+        nonlocal s
+        if processes:
+            _dill()  # imported once, before the processes are forked
+        results = _map(serialize, candidates, workers,
+                       in_process=_forkable if processes else None, process_function=serialize_in_process)
+        for (k, v), (serialized, fingerprint, blob, times, fmt) in zip(candidates, results):
+            if isinstance(serialized, Exception):
+                _remember_unpicklable(v, serialized)  # again, if it failed in a forked process
                 could_not_pickle.append(k)
+                if report is not None:
+                    report.skipped[k] = f'could not pickle: {serialized}'
                 continue
-        except:
-            could_not_pickle.append(k)
-            continue
-        s = s + k + ' '
-        data[k] = v
-    s = s + ']'
-    if len(data) == 0:
-        log.warning('Could not find any local variables to save')
-        return
-    if filename is None:
-        log.error('you must supply a filename')
-        return
-    from pathlib import Path
-    dill_file_path = Path(filename)
-    if dill_file_path.suffix == '':  # if suffix is missing add .dill
-        dill_file_path = dill_file_path.parent / (dill_file_path.name + _DILL_EXTENSION)
+            fingerprints[k] = fingerprint
+            if serialized is None:
+                unchanged.append(k)
+                if report is not None:
+                    report.skipped[k] = 'unchanged'
+            else:
+                data[k] = dict(_describe(v), **fmt)
+                seconds[k] = times
+                if blob is not None:
+                    blobs[k] = blob
+                    if not serialized[0] and not serialized[1]:  # see serialize()
+                        existing_blobs.add(blob)
+                yield k, serialized, data[k]
+            s = s + k + ' '
+        s = s + ']'
+        if report is not None:
+            report.phases['serialize'] = time.perf_counter() - phase
+
+    def write(items, handle=None):
+        """ writes the (name, serialized value, metadata) items to the file,
+            compressing them first if this is a background save with handle """
+        phase = time.perf_counter()
+        if store is not None:
+            _register_manifest(store, dill_file_path)
+        if handle is None:
+            records = ((k, encoded, None, meta) for k, encoded, meta in items)
+        else:
+            encoded = _map(encode, (serialized for _, serialized, _ in items), workers)
+            records = ((k, e, compress_seconds, meta) for (k, _, meta), (e, compress_seconds) in zip(items, encoded))
+
+        def write_records(writer):
+            for k, (payload, buffers, codec_meta), compress_seconds, meta in records:
+                entry = None
+                if k in blobs:
+                    blob_path = _blob_path(store, blobs[k])
+                    if blobs[k] in existing_blobs:
+                        if not blob_path.exists():
+                            raise ValueError(f'blob of variable "{k}" was deleted from {store} while saving')
+                    else:
+                        fmt = {key: meta[key] for key in _FORMAT_KEYS if key in meta}
+                        entry = _write_blob(blob_path, blobs[k], payload, buffers, dict(codec_meta, **fmt))
+                    writer.add(k, b'', blob=_relative_path(blob_path, dill_file_path.parent), **meta)
+                else:
+                    writer.add(k, payload, buffers, **meta, **codec_meta)
+                if handle is not None:
+                    handle.written += 1
+                if report is not None:
+                    if compress_seconds is not None:
+                        seconds[k]['compress'] = compress_seconds
+                    report.add(dict(entry or writer.index[-1], name=k, **meta), **seconds[k])
+
+        if stream is not None:
+            writer = _ContainerWriter(stream)
+            write_records(writer)
+            writer.close()
+            stream.flush()
+        elif saved_fingerprints is None:
+            with _atomic_write(dill_file_path, keep) as f:
+                writer = _ContainerWriter(f)
+                write_records(writer)
+                writer.close()
+                _check_written(f, writer, dill_file_path)
+        else:
+            with _appending(dill_file_path, lambda e: e['name'] in unchanged) as (writer, index):
+                for e in index:
+                    if e['name'] not in unchanged and e['name'] not in data:
+                        writer.delete(e['name'])
+                write_records(writer)
+        if len(data) == 0:  # only possible when streaming, otherwise savevars returned before writing
+            log.warning(f'Could not find any local variables to save, wrote an empty container to {dill_file_path}')
+        elif saved_fingerprints is None:
+            log.info(f'Saved to {dill_file_path} variables [ {s}')  # show what we saved
+        else:
+            log.info(f'Appended to {dill_file_path} changed variables {list(data.keys())}, '
+                     f'{len(unchanged)} unchanged')
+        if store is not None:
+            log.info(f'{len(blobs) - len(existing_blobs)} new and {len(existing_blobs)} existing blobs in store {store}')
+        if len(could_not_pickle) > 0:
+            log.warning(f'could not pickle: {could_not_pickle}')
+        _whos_fingerprints.update((k, (fingerprint, native)) for k, fingerprint in fingerprints.items())
+        if incremental:
+            _incremental_files[str(dill_file_path.resolve())] = (_file_stamp(dill_file_path), fingerprints)
+            live = sum(e['length'] + sum(length for _, length in e.get('buffers', ())) for e in writer.index)
+            if writer.pos > 2 * live + 4096:
+                log.info(f'{dill_file_path} is {_format_bytes(writer.pos)} but holds {_format_bytes(live)} '
+                         f'of variables, use compactvars() to shrink it')
+        if report is not None:
+            report.phases['write'] = time.perf_counter() - phase
+            report.phases['total'] = time.perf_counter() - start
+            _emit_report(report, profile, log)
+            if handle is not None:
+                handle.report = report
+
+    if stream is not None and not background:  # write each variable as soon as it is serialized
+        items = serialized_vars()
+    else:
+        items = list(serialized_vars())
+        if len(data) == 0 and len(unchanged) == 0:
+            log.warning('Could not find any local variables to save')
+            return
+        if saved_fingerprints is not None and len(data) == 0 and len(unchanged) == len(saved_fingerprints):
+            log.info(f'No variables changed since they were saved to {dill_file_path}')
+            return
     if not type(overwrite) is bool and not overwrite in ('yes', 'no', 'prompt'):
         raise ValueError(f"argument 'overwrite' must be True or False or one of ('yes', 'no', 'prompt')")
-    if dill_file_path.exists():
-        if overwrite == False or overwrite == 'no' or (
-                overwrite == 'prompt' and _yes_or_no_or_always(f'file {dill_file_path} already exists, overwrite it?',
-                                                               default='y', always_option=False) == 'n'):
+    # appending to the file this process saved incrementally overwrites nothing, so it is not asked about
+    if stream is None and saved_fingerprints is None and dill_file_path.exists():
+        if policy is not None:
+            cancel = not policy.overwrite_files
+        else:
+            question = f'file {dill_file_path} already exists, overwrite it?'
+            cancel = overwrite == False or overwrite == 'no' or (
+                    overwrite == 'prompt' and _yes_or_no_or_always(question, default='y', always_option=False) == 'no')
+        if cancel:
             log.info('cancelled')
             return
-    try:
-        with open(dill_file_path, 'wb') as f:
+
+    if background:
+        handle = SaveHandle(dill_file_path, len(data))
+
+        def write_in_background():
             try:
-                dill.dump(data, f)
-                log.info(f'Saved to {dill_file_path} variables [ {s}')  # show what we saved
-                if len(could_not_pickle) > 0:
-                    log.warning(f'could not pickle: {could_not_pickle}')
-            except TypeError as e:
-                log.error(f'\n Error: {e}')
+                write(items, handle)
+            except Exception as e:
+                log.error(f'could not save data to {dill_file_path} in background: {e}')
+                raise
+
+        handle._future = _background_executor().submit(write_in_background)
+        if stream is None:
+            _background_saves[str(dill_file_path.resolve())] = handle
+        return handle
+    try:
+        write(items)
     except Exception as e:
-        log.error(f'could not save data to {dill_file_path}')
+        log.error(f'could not save data to {dill_file_path}: {e}')
+        raise
+    return report
+
+
+def _rotate(path, keep):
+    """ keeps the current file at path as generation path.1, path.1 as path.2, ... up to path.keep """
+    if keep <= 0 or not path.exists():
+        return
+    for i in range(keep - 1, 0, -1):
+        older = path.with_name(f'{path.name}.{i}')
+        if older.exists():
+            os.replace(older, path.with_name(f'{path.name}.{i + 1}'))
+    newest = path.with_name(f'{path.name}.1')
+    try:  # a hard link keeps the current file in place until it is replaced
+        if newest.exists():
+            newest.unlink()
+        os.link(path, newest)
+    except OSError:
+        os.replace(path, newest)
+
+
+@contextlib.contextmanager
+def _atomic_write(path, keep=0):
+    """ Context manager for writing a file so that it is either completely written or not changed at all.
+
+    It yields a buffered binary file that is a temporary sibling of path. When the block ends without an exception,
+    the file is flushed and fsynced, the existing file is rotated (see _rotate), and the temporary file is renamed
+    to path. If the block raises, the temporary file is deleted and path is untouched.
+
+    :param path: the Path to write
+    :param keep: the number of previous generations of the file to keep
+    """
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}-{os.urandom(4).hex()}.tmp')
+    f = os.fdopen(os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666),
+                  'w+b', buffering=_WRITE_BUFFER_SIZE)
+    try:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        _rotate(path, keep)
+        os.replace(tmp_path, path)
+    except BaseException:
+        f.close()
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+    if os.name != 'nt':  # make the rename durable; directories cannot be opened on windows
+        with contextlib.suppress(OSError):
+            fd = os.open(path.parent, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+@contextlib.contextmanager
+def _appending(path, keep):
+    """ Context manager for appending records to the container at path in place.
+    The old index stays valid until the new index and trailer are written when the block ends,
+    after the new records are on disk, so a crash while appending leaves the file as it was (see _ContainerReader).
+
+    :param path: the Path of the container
+    :param keep: function of an index entry that is True for the variables that stay in the index
+    :returns: yields a _ContainerWriter positioned at the end of the file, and the old index
+    """
+    with open(path, 'r+b', buffering=_WRITE_BUFFER_SIZE) as f:
+        reader = _ContainerReader(f)
+        f.seek(reader.index_offset)
+        crc = None if reader.crc32 is None else zlib.crc32(f.read(), reader.crc32)  # leaves f at the end
+        writer = _ContainerWriter(f, [e for e in reader.index if keep(e)], crc)
+        yield writer, reader.index
+        f.flush()
+        os.fsync(f.fileno())  # the records are on disk before the index that refers to them
+        writer.close()
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@contextlib.contextmanager
+def _locked(path, shared=False):
+    """ Context manager that holds a lock of the lock file of path, waiting until other processes
+    (or threads) release theirs. The lock file is left in place, since removing it would race with waiting lockers.
+
+    :param path: the Path to lock; the lock file is the hidden sibling .name.lock
+    :param shared: True for a shared lock that only excludes exclusive locks; exclusive on windows
+    """
+    with open(path.with_name(f'.{path.name}.lock'), 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)  # retries for 10 s, then raises
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _check_written(f, writer, path):
+    """ Reads file f back after writer wrote it, before it is renamed to path: its trailer and index must be the ones
+    that were written, and the crc32 of the bytes in the file must match the checksum in the index, which writer
+    computed from the bytes it wrote. This catches short writes and data changed on its way to the file.
+
+    :raises ValueError: if they do not match """
+    f.flush()
+    reader = _ContainerReader(f)
+    if reader.recovered or reader.crc32 != writer.index_crc or len(reader.index) != len(writer.index):
+        raise ValueError(f'{path} was not written correctly')
+    try:
+        reader.verify()
+    except ValueError:
+        raise ValueError(f'{path} was not written correctly, the checksum of the written bytes does not match') \
+            from None
+
+
+class SaveHandle:
+    """ Returned by savevars(background=True) to follow the background write of the file.
+
+    `wait()` blocks until the file is written and raises the error if writing failed,
+    `done()` tells if it finished, `progress` is the fraction of variables written, and `error` is the exception
+    if writing failed, else None. With savevars(profile=True), `report` is the VarsReport once the file is written.
+    """
+
+    def __init__(self, path, total):
+        self.path = path
+        self.total = total
+        self.written = 0
+        self.report = None
+        self._future = None
+
+    @property
+    def progress(self):
+        """ the fraction of the variables written so far, from 0 to 1 """
+        return self.written / self.total if self.total else 1.0
+
+    def done(self):
+        """ :returns: True if the file is written or writing failed """
+        return self._future.done()
+
+    def wait(self, timeout: Optional[float] = None):
+        """ Waits until the file is written
+
+        :param timeout: the maximum time to wait in seconds, None to wait until it is done
+        :raises: the exception of the background write if it failed, or concurrent.futures.TimeoutError
+        """
+        self._future.result(timeout)
+
+    @property
+    def error(self):
+        """ the exception if the background write failed, None if it succeeded or is still running """
+        return self._future.exception() if self._future.done() else None
+
+    def __repr__(self):
+        state = 'failed' if self.error is not None else 'done' if self.done() else f'{self.progress:.0%} written'
+        return f'<SaveHandle {self.path}: {state}>'
+
+
+_EXCLUDED_TYPES = (ModuleType, logging.Logger, SaveHandle)  # variables of these types are never saved, see _is_var
+_background_saves = {}  # resolved path -> SaveHandle of the last background save of that file
+_background_executor_instance = None
+
+
+def _background_executor():
+    """ :returns: the single thread executor of background saves, which writes them in the order they were made """
+    global _background_executor_instance
+    if _background_executor_instance is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _background_executor_instance = ThreadPoolExecutor(max_workers=1, thread_name_prefix='savevars')
+    return _background_executor_instance
+
+
+def _wait_for_background(path):
+    """ waits for a background save of the file at path to finish, whether it succeeds or not """
+    handle = _background_saves.pop(str(path.resolve()), None)
+    if handle is not None and not handle.done():
+        logging.getLogger(_LOGGER_NAME).info(f'waiting for background save of {path} to finish')
+        handle._future.exception()
+
+
+def _snapshot(serialized):
+    """ :returns: the result of _dumps with the out-of-band buffers of writable arrays copied,
+        so that a background save writes the values as they were when savevars was called """
+    payload, buffers = serialized
+    return payload, [b if b.raw().readonly else bytes(b.raw()) for b in buffers]
+
+
+def _serialized_size(serialized):
+    """ :returns: the number of bytes of the result of _dumps """
+    payload, buffers = serialized
+    return len(payload) + sum(memoryview(b).nbytes for b in buffers)
+
+
+def _blob_path(store, key):
+    """ :returns: the Path of the blob with hex key in the store directory """
+    return Path(store) / 'objects' / key[:2] / key[2:]
+
+
+def _relative_path(path, start):
+    """ :returns: path relative to directory start if possible (so that they can be moved together), else absolute """
+    try:
+        return os.path.relpath(path, start)
+    except ValueError:  # on another drive
+        return os.path.abspath(path)
+
+
+def _write_blob(path, key, payload, buffers, codec_meta):
+    """ Writes a blob of a store, unless it exists already. A blob is a container with a single record.
+    codec_meta is the metadata that is needed to decode it, i.e. that of _encode and the native format.
+
+    :returns: the index entry of the record if the blob was written, None if it existed
+    """
+    if path.exists():
+        return None
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with _atomic_write(path) as f:
+        writer = _ContainerWriter(f)
+        writer.add(key, payload, buffers, **codec_meta)
+        writer.close()
+    return writer.index[0]
+
+
+def _register_manifest(store, path):
+    """ records in the store that the file at path may refer to its blobs, so that gcvars looks at it """
+    path = os.path.abspath(path)
+    ref = Path(store) / 'manifests' / _hash_buffers(path.encode()).hex()
+    if not ref.exists():
+        ref.parent.mkdir(parents=True, exist_ok=True)
+        ref.write_text(path)
+
+
+def gcvars(store: str, logging_level=_LOGGING_LEVEL):
+    """ Deletes the blobs of a store (see the store argument of savevars) that no file refers to any more,
+    i.e. the blobs of variables that were only in files that were since overwritten, compacted or deleted.
+    Previous versions kept by savevars(keep=n) count as references. Do not run it while other processes save to the store.
+
+    :param store: the store directory
+    :param logging_level: set a different logging level (for testing)
+    :returns: the number of blobs deleted and the number of bytes they took
+    """
+    log = get_logger(logging_level)
+    store = Path(store)
+    for handle in list(_background_saves.values()):  # their blobs may not be referenced yet
+        handle._future.exception()
+    referenced = set()
+    for ref in (store / 'manifests').glob('*'):
+        manifest = Path(ref.read_text())
+        generations = [manifest] + [p for p in manifest.parent.glob(glob.escape(manifest.name) + '.*')
+                                    if p.name[len(manifest.name) + 1:].isdigit()]
+        if not any(p.exists() for p in generations):
+            ref.unlink()
+            continue
+        for path in generations:
+            try:
+                with open(path, 'rb') as f:
+                    if not _is_container(f):
+                        continue
+                    for e in _ContainerReader(f).index:
+                        if 'blob' in e:
+                            referenced.add(os.path.realpath(os.path.join(path.parent, e['blob'])))
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as e:
+                log.warning(f'not collecting garbage in {store}: could not read {path}: {e}')
+                return 0, 0
+    deleted = freed = 0
+    for blob in (store / 'objects').glob('*/*'):
+        if blob.name.startswith('.') or os.path.realpath(blob) in referenced:  # .tmp files are blobs being written
+            continue
+        freed += blob.stat().st_size
+        blob.unlink()
+        deleted += 1
+        with contextlib.suppress(OSError):  # fails unless the directory is empty
+            blob.parent.rmdir()
+    log.info(f'deleted {deleted} unreferenced blobs ({_format_bytes(freed)}) from {store}, '
+             f'{len(referenced)} blobs are in use')
+    return deleted, freed
+
+
+def compactvars(filename: str = _DEFAULT_FILENAME, logging_level=_LOGGING_LEVEL):
+    """ Rewrites a file saved with savevars(incremental=True) so that it only holds the current version
+    of each variable, dropping superseded records and tombstones. Records are copied without unpickling them.
+
+    :param filename: the file, as for savevars
+    :param logging_level: set a different logging level (for testing)
+    """
+    log = get_logger(logging_level)
+    dill_file_path = _dill_path(filename)
+    _wait_for_background(dill_file_path)
+    size = _file_stamp(dill_file_path)[0]
+    with open(dill_file_path, 'rb') as f:
+        if not _is_container(f):
+            log.info(f'{dill_file_path} was saved by an older version and has nothing to compact')
+            return
+        reader = _ContainerReader(f)
+        with _atomic_write(dill_file_path) as out:
+            writer = _ContainerWriter(out)
+            for e in reader.index:
+                meta = {k: v for k, v in e.items() if k not in ('name', 'length', 'offset', 'buffers')}
+                writer.add(e['name'], reader.read(e), reader.read_buffers(e), **meta)
+            writer.close()
+            _check_written(out, writer, dill_file_path)
+    key = str(dill_file_path.resolve())
+    if key in _incremental_files:  # same variables, so incremental saves can still append
+        _incremental_files[key] = (_file_stamp(dill_file_path), _incremental_files[key][1])
+    log.info(f'compacted {dill_file_path} from {_format_bytes(size)} to {_format_bytes(writer.pos)}')
+
+
+def _shard_paths(directory):
+    """ :returns: the merged file of the sharded checkpoint in directory (which may not exist), and its shards """
+    directory = Path(directory)
+    return directory / _MERGED_SHARDS, sorted(p for p in directory.glob('*' + _DILL_EXTENSION)
+                                              if p.name != _MERGED_SHARDS)
+
+
+def saveshard(directory: str, namespaces: dict, writer: Optional[str] = None, vars: Union[list, str, None] = None,
+              workers: Optional[int] = 1, compression: Optional[str] = None, compression_threshold: int = 4096,
+              native: Union[bool, str] = False, logging_level=_LOGGING_LEVEL):
+    """ Saves the variables of many namespaces, e.g. the results of the runs of a parameter sweep, into a sharded
+    checkpoint directory that is shared by many writers, e.g. worker processes on many machines.
+
+    Each writer appends to its own shard, directory/writer.dill, which holds the variable `x` of namespace `key`
+    as the variable 'key/x', so concurrent writers never write to the same file. Saving a namespace again replaces
+    its variables. The shard is locked while it is written, so writers that share a name wait for each other,
+    and mergeshards() does not merge a shard while it is written. Use gathervars() to collect a variable from all
+    namespaces, and mergeshards() to merge the shards into one file.
+
+    :param directory: the directory of the checkpoint; it is created if needed
+    :param namespaces: dict of the namespaces by their keys, which are strings; each namespace is a dict of variables.
+        Variables are selected as for savevars, e.g. functions and names starting with _ are not saved.
+    :param writer: the name of the shard of this writer, default the host name and process id
+    :param vars: a list of names or a unix style wildcard string of the variables to save, as for savevars
+    :param workers: the number of threads that serialize variables, as for savevars
+    :param compression: the codec, as for savevars
+    :param compression_threshold: as for savevars
+    :param native: as for savevars
+    :param logging_level: set a different logging level (for testing)
+    :returns: the Path of the shard
+    :raises ValueError: if a key is not a string
+    """
+    log = get_logger(logging_level)
+    if writer is None:
+        import socket
+        writer = f'{socket.gethostname()}-{os.getpid()}'
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'{writer}{_DILL_EXTENSION}'
+    if path.name == _MERGED_SHARDS:
+        raise ValueError(f'{writer} is not a valid writer name, {_MERGED_SHARDS} is the merged file')
+    codec = _available_codec(compression)
+    candidates = []
+    for key, namespace in namespaces.items():
+        if type(key) is not str:
+            raise ValueError(f'namespace keys must be strings, not {key!r}')
+        names = [k for k, v in namespace.items() if not _is_var(k, v)]
+        candidates += [(f'{key}/{k}', namespace[k]) for k in (names if vars is None else _select_vars(names, vars))]
+    could_not_pickle = []
+
+    def serialize(item):
+        """ :returns: the _encode() result and the index metadata of a variable, or None if it cannot be pickled """
+        name, v = item
+        if _unpicklable_reason(v) is not None:
+            return None
+        try:
+            serialized = _dumps_native(v, native) if native else None
+            serialized, fmt = (_dumps(v), {}) if serialized is None else serialized
+        except Exception as e:
+            _remember_unpicklable(v, e)
+            return None
+        encoded = _encode(serialized, codec, compression_threshold, sample=compression == 'auto')
+        return encoded, dict(_describe(v), **fmt)
+
+    def write_records(container):
+        for (name, _), result in zip(candidates, _map(serialize, candidates, workers)):
+            if result is None:
+                could_not_pickle.append(name)
+                continue
+            (payload, buffers, codec_meta), meta = result
+            container.add(name, payload, buffers, **meta, **codec_meta)
+
+    with _locked(path):
+        if path.exists():  # the variables of the namespaces that were saved before are replaced
+            with _appending(path, lambda e: e['name'].rpartition('/')[0] not in namespaces) as (container, _):
+                write_records(container)
+        else:
+            with _atomic_write(path) as f:
+                container = _ContainerWriter(f)
+                write_records(container)
+                container.close()
+                _check_written(f, container, path)
+    log.info(f'saved {len(candidates) - len(could_not_pickle)} variables of {len(namespaces)} namespaces to {path}')
+    if could_not_pickle:
+        log.warning(f'could not pickle: {could_not_pickle}')
+    return path
+
+
+def mergeshards(directory: str, logging_level=_LOGGING_LEVEL):
+    """ Merges the shards of a sharded checkpoint written by saveshard into one file, directory/merged.dill, and
+    deletes them, so that the checkpoint is a single file that is fast to scan. Records are copied without unpickling.
+    Writers can keep saving while it runs; they wait for the merge of their shard and then start a new shard.
+    A namespace that is in several shards is taken from the last shard in name order.
+
+    :param directory: the directory of the checkpoint
+    :param logging_level: set a different logging level (for testing)
+    :returns: the Path of the merged file
+    """
+    log = get_logger(logging_level)
+    merged, _ = _shard_paths(directory)
+    with _locked(merged), contextlib.ExitStack() as locks:  # one merge at a time, and no gathervars while merging
+        _, shards = _shard_paths(directory)
+        for shard in shards:
+            locks.enter_context(_locked(shard))
+        sources = ([merged] if merged.exists() else []) + [p for p in shards if p.exists()]
+        files = [locks.enter_context(open(p, 'rb')) for p in sources]
+        readers = [_ContainerReader(f) for f in files]
+        latest = {}  # namespace key -> the index of the last reader that has it
+        for i, reader in enumerate(readers):
+            for e in reader.index:
+                latest[e['name'].rpartition('/')[0]] = i
+        with _atomic_write(merged) as out:
+            writer = _ContainerWriter(out)
+            for i, reader in enumerate(readers):
+                for e in reader.index:
+                    if latest[e['name'].rpartition('/')[0]] == i:
+                        meta = {k: v for k, v in e.items() if k not in ('name', 'length', 'offset', 'buffers')}
+                        writer.add(e['name'], reader.read(e), reader.read_buffers(e), **meta)
+            writer.close()
+            _check_written(out, writer, merged)
+        for f in files:
+            f.close()
+        for shard in sources:
+            if shard != merged:
+                shard.unlink()
+    log.info(f'merged {len(shards)} shards into {merged}, {len(latest)} namespaces, {_format_bytes(writer.pos)}')
+    return merged
+
+
+def gathervars(directory: str, var: str, stack: bool = False, keys: bool = False, logging_level=_LOGGING_LEVEL):
+    """ Gathers a variable from all namespaces of a sharded checkpoint written by saveshard, e.g. the result of
+    every run of a parameter sweep. Only the indexes of the merged file and the shards, and the records of the
+    variable are read.
+
+    :param directory: the directory of the checkpoint
+    :param var: the name of the variable
+    :param stack: `True` stacks the values into one numpy array along a new first axis
+    :param keys: `True` also returns the keys of the namespaces
+    :param logging_level: set a different logging level (for testing)
+    :returns: the list (or stacked array) of the values, ordered by the keys of their namespaces,
+        or the list of keys and the values if `keys=True`. Namespaces without the variable are left out.
+    """
+    get_logger(logging_level)
+    merged, _ = _shard_paths(directory)
+    entries = {}  # namespace key -> the last file that has the namespace, as for mergeshards, and the entry of var
+    with _locked(merged, shared=True):
+        _, shards = _shard_paths(directory)
+        for path in ([merged] if merged.exists() else []) + shards:
+            with open(path, 'rb') as f:
+                for e in _ContainerReader(f).index:
+                    key, _, name = e['name'].rpartition('/')
+                    if key not in entries or entries[key][0] != path:
+                        entries[key] = [path, None]
+                    if name == var:
+                        entries[key][1] = e
+        gathered = sorted(k for k in entries if entries[k][1] is not None)
+        values = {}
+        for path in dict.fromkeys(entries[k][0] for k in gathered):
+            with open(path, 'rb') as f:
+                reader = _ContainerReader(f)
+                for k in gathered:
+                    if entries[k][0] == path:
+                        values[k] = _load_entry(reader, entries[k][1])
+    values = [values[k] for k in gathered]
+    if stack:
+        import numpy
+        values = numpy.stack(values)
+    return (gathered, values) if keys else values
+
+
+def listvars(filename: str = _DEFAULT_FILENAME, vars: Union[list, str, None] = None, logging_level=_LOGGING_LEVEL):
+    """ Lists the variables in a file saved by savevars without loading them.
+    Only the index at the end of the file is read, so it is as fast for huge files as for small ones,
+    and nothing is unpickled, so it is safe for files of unknown provenance.
+
+    :param filename: the file, as for loadvars
+    :param vars: a list of names or a unix style wildcard string of the variables to list, as for loadvars
+    :param logging_level: set a different logging level (for testing)
+    :returns: list with a dict for each variable: its 'name', 'type', 'size' in memory, 'stored' bytes in the file
+        (or its store), its 'shape' and 'dtype' if it has them, the 'codec' if it is compressed, the 'format' if it
+        was saved with savevars(native=...), and 'saved',
+        the local time the file was saved as 'YYYY-MM-DD HH:MM:SS'
+    :raises ValueError: if the file was saved by a version before 0.4, which can only be inspected by loading it
+    """
+    get_logger(logging_level)
+    dill_file_path = _dill_path(filename)
+    _wait_for_background(dill_file_path)
+    with open(dill_file_path, 'rb') as f:
+        if not _is_container(f):
+            raise ValueError(f'{dill_file_path} was saved by an older version of savevars, load it to see its variables')
+        reader = _ContainerReader(f)
+    saved = None if reader.saved is None else time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reader.saved))
+    entries = {e['name']: e for e in reader.index}
+    variables = []
+    for k in _select_vars(entries.keys(), vars, 'variable in the file'):
+        e = entries[k]
+        if 'blob' in e:
+            try:
+                stored = os.path.getsize(os.path.join(dill_file_path.parent, e['blob']))
+            except OSError:
+                stored = 0
+        else:
+            stored = e['length'] + sum(length for _, length in e.get('buffers', ()))
+        info = dict(name=k, type=e.get('type', '?'), size=e.get('size', 0), stored=stored)
+        info.update((key, e[key]) for key in ('shape', 'dtype', 'codec', 'format') if key in e)
+        info['saved'] = saved
+        variables.append(info)
+    return variables
+
+
+def _format_listing(path, variables):
+    """ :returns: the result of listvars as a table """
+    saved = variables[0]['saved'] if variables else None
+    lines = [f'{path}: {len(variables)} variables' + (f', saved {saved}' if saved else '')]
+    for v in variables:
+        shape = 'x'.join(str(n) for n in v['shape']) if 'shape' in v else ''
+        lines.append(f'  {v["name"]:20} {v["type"]:24} {shape:>14} {v.get("dtype", ""):>9} '
+                     f'{_format_bytes(v["size"]):>9} {_format_bytes(v["stored"]):>9} {v.get("codec", "")} '
+                     f'{v.get("format", "")}'.rstrip())
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """ Command line entry point, `python -m jupyter_save_load_vars file ...`, that lists the variables in files
+    saved by savevars without loading them, see listvars.
+
+    :param argv: the arguments, default sys.argv[1:]
+    :returns: the exit status, 1 if a file could not be listed
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m jupyter_save_load_vars',
+                                     description='Lists the variables in files saved by savevars without loading them')
+    parser.add_argument('files', nargs='+', help='the files; .dill is added to names without suffix')
+    parser.add_argument('--vars', help='unix style wildcard of the variables to list, e.g. "a*"')
+    parser.add_argument('--json', action='store_true', help='print a line of JSON for each variable instead')
+    args = parser.parse_args(argv)
+    status = 0
+    for filename in args.files:
+        try:
+            variables = listvars(filename, args.vars, logging_level=logging.WARNING)
+        except (OSError, ValueError) as e:
+            print(f'{filename}: {e}', file=sys.stderr)
+            status = 1
+            continue
+        if args.json:
+            for v in variables:
+                print(json.dumps(dict(file=str(_dill_path(filename)), **v)))
+        else:
+            print(_format_listing(_dill_path(filename), variables))
+    return status
 
 
 def loadvars(filename: str = _DEFAULT_FILENAME, overwrite: Union[str, bool] = 'prompt', warn: bool = True,
-             logging_level=_LOGGING_LEVEL):
+             vars: Union[list, str, None] = None, mmap: bool = False, lazy: bool = False,
+             workers: Optional[int] = 1, verify: bool = False, profile: Union[bool, Callable] = False,
+             columns: Optional[dict] = None, namespace: Optional[dict] = None, policy: Optional[VarsPolicy] = None,
+             max_memory: Optional[int] = None, logging_level=_LOGGING_LEVEL):
     """ Loads variables from file into the current workspace
     This function loads the variables found in filename into the parent workspace.
     
     :param filename: the dill file to load from, e.g. lab1. The suffix .dill is added automatically unless there is already a suffix.
         A default filename is loaded if it is not supplied.
+        It can also be a binary file object opened for reading, e.g. a pipe, socket, io.BytesIO or tar member,
+        which is read sequentially to its end, one variable at a time. mmap and lazy need a filename.
     :param overwrite: 'prompt' (default) asks to overwrite, 'no' or `False` does not overwrite, 'yes' or `True` overwrites silently.
     :param warn: `True`, warn the user one a day about dangers of unpickling any file,
         `False`, don't warn
+    :param vars: a list of string names of variables to load, or a unix style wildcard string, as for savevars.
+        If `vars=None` (default), all variables in the file are loaded.
+        Only the selected variables are read and unpickled from files written by this version of savevars.
+    :param mmap: `True` backs the data of numpy arrays (and pandas frames) by a copy-on-write memory map of the file
+        instead of reading it into memory, so that large arrays load almost instantly and only pages that are used
+        are read. Do not overwrite the file in place while such arrays are in use.
+    :param lazy: `True` puts a LazyVar placeholder for each variable into the workspace, which loads the variable
+        from the file when it is first used. Its repr shows the type and size of the variable without loading it.
+    :param workers: the number of threads that read, decompress and unpickle variables concurrently, None for one
+        per CPU. Unpickling python objects holds the GIL, so threads only speed up decompression and array data.
+    :param verify: `True` checks the checksum of the whole file before loading anything from it.
+    :param profile: `True` measures the read, decompress and deserialize time and stored size of each variable and
+        the time of each phase of the load, logs the slowest variables and returns the VarsReport.
+        A function is called with the VarsReport.
+    :param columns: dict of the names of DataFrame variables and the list of their columns to load, e.g.
+        `columns={'df': ['time', 'price']}`. Frames saved with savevars(native=True) read only these columns
+        from the file; other frames are loaded and then selected.
+    :param namespace: a dict to load the variables into instead of the workspace of the caller
+    :param policy: a VarsPolicy that decides which existing variables are overwritten and which files are trusted,
+        instead of `overwrite` and `warn`, without prompting
+    :param max_memory: the bytes of memory that the loaded variables may take, estimated from their sizes in memory
+        recorded by savevars; memory mapped array data (see `mmap`) does not count. The smallest variables are loaded
+        first, and those that do not fit any more are put into the workspace as LazyVar placeholders that memory map
+        their arrays when they are used. From a file object they are not loaded at all. They are logged and listed in
+        the `deferred` of the VarsReport.
     :param logging_level: set a different logging level.
         default is logging.INFO. Use it for testing, must import logging and use e.g. logging.DEBUG
 
+    :returns: the VarsReport if `profile` is set, else None
     :raises ExceptionType: if it cannot load for any reason except \
         not being able to overwrite particular variables.
+    :raises PermissionError: if the policy does not trust the file
+    :raises MemoryError: if a file saved by a version before 0.4 is larger than max_memory
     """
     log = get_logger(logging_level)
+    start = time.perf_counter()
     assert (type(overwrite) is bool or overwrite == 'yes' or overwrite == 'no' or overwrite == 'prompt'), \
         f'overwrite={overwrite} is invalid, must be bool, "yes", "no", or "prompt"'
-    import dill
-    from pathlib import Path
-    dill_file_path = Path(filename)
-    if dill_file_path.suffix == '':  # if suffix is missing add .dill
-        dill_file_path = dill_file_path.parent / (dill_file_path.name + _DILL_EXTENSION)
-    assert FileNotFoundError, f'Path {dill_file_path} does not exist'
-    from os import access, R_OK
-    from os.path import isfile
-    assert isfile(dill_file_path) and access(dill_file_path, R_OK), \
-        f"File {dill_file_path} doesn't exist or isn't readable"
-    if warn:
+    if lazy and columns:
+        raise ValueError('columns cannot be selected when loading lazily')
+    stream = filename if hasattr(filename, 'read') else None
+    if stream is not None:
+        if mmap or lazy:
+            raise ValueError('mmap and lazy need a filename, not a file object')
+        dill_file_path = getattr(stream, 'name', f'<{type(stream).__name__}>')  # for the messages
+    else:
+        dill_file_path = _dill_path(filename)
+        _wait_for_background(dill_file_path)
+        assert FileNotFoundError, f'Path {dill_file_path} does not exist'
+        assert os.path.isfile(dill_file_path) and os.access(dill_file_path, os.R_OK), \
+            f"File {dill_file_path} doesn't exist or isn't readable"
+    if policy is not None:
+        if not policy.trusts(dill_file_path):
+            raise PermissionError(f'{dill_file_path} is not trusted by {policy}, not unpickling it')
+    elif warn:
         try:
-            import tempfile, os, pathlib, time
-            ran_today_path = Path(os.path.join(tempfile.tempdir, _RAN_SAVELOADVARS_TODAY_FILENAME))
+            import tempfile
+            ran_today_path = Path(tempfile.gettempdir()) / _RAN_SAVELOADVARS_TODAY_FILENAME
             warning_msg = f'Unpickling file "{dill_file_path}" can be used maliciously to execute arbitrary code.\nThis warning (shown once per 24h) can be suppressed with argument warn=False.\n Do you trust "{dill_file_path}"?'
             if ran_today_path.exists():
                 seconds_since_last_ran = time.time() - os.path.getmtime(ran_today_path)
@@ -278,22 +2593,49 @@ def loadvars(filename: str = _DEFAULT_FILENAME, overwrite: Union[str, bool] = 'p
             log.warning(f'could not warning user about unpickling: {e}')
     did_not_overwrite = []
     overwrote = []
-    with open(dill_file_path, 'rb') as f:
+    deferred = {}
+    report = VarsReport('loadvars', dill_file_path) if profile else None
+    with open(dill_file_path, 'rb') if stream is None else contextlib.nullcontext(stream) as f:
         try:
-            data = dill.load(f)
+            phase = time.perf_counter()
+            if stream is not None:
+                data = _read_stream(f, vars, verify=verify, workers=workers, report=report, columns=columns,
+                                    max_memory=max_memory, deferred=deferred)
+            else:
+                if verify and _is_container(f):
+                    _ContainerReader(f).verify()
+                    if report is not None:
+                        report.phases['verify'], phase = time.perf_counter() - phase, time.perf_counter()
+                data = _read_vars(f, vars, use_mmap=mmap, lazy=lazy, workers=workers, report=report,
+                                  columns=columns, max_memory=max_memory, deferred=deferred)
+            if report is not None:
+                report.phases['load'], phase = time.perf_counter() - phase, time.perf_counter()
         except Exception as e:
             log.error(f'could load load dill: got {e}')
             raise (e)
-        log.info(f'from {dill_file_path} loaded variables {list(data.keys())}')
-        import inspect
+        log.info(f'from {dill_file_path} {"lazily " if lazy else ""}loaded variables {list(data.keys())}')
+        if deferred:
+            log.warning(f'variables {list(deferred)} ({_format_bytes(sum(deferred.values()))}) do not fit into '
+                        f'max_memory={_format_bytes(max_memory)}, ' +
+                        ('they were not loaded' if stream is not None else 'they are LazyVars that load when used'))
+            if report is not None:
+                report.deferred = deferred
         try:
-            frame = inspect.currentframe().f_back  # get the workspace frame (jupyter workspace frame)
-            locals = frame.f_locals  # get its local variable dict
+            frame = sys._getframe(1)  # get the workspace frame (jupyter workspace frame)
+            locals = frame.f_locals if namespace is None else namespace  # get its local variable dict
             always = False
+            if policy is not None:
+                allowed = policy.overwritten([k for k in data if k in locals.keys()])
             for k in data:
                 try:
                     if k in locals.keys():  # if variable exists
-                        if overwrite == 'yes' or always or ((type(overwrite) is bool) and overwrite):
+                        if policy is not None:
+                            if k in allowed:
+                                locals[k] = data[k]
+                                overwrote.append(k)
+                            else:
+                                did_not_overwrite.append(k)
+                        elif overwrite == 'yes' or always or ((type(overwrite) is bool) and overwrite):
                             # if always overwrite (yes) or prompt returns True
                             locals[k] = data[k]  # set a value in it
                             overwrote.append(k)
@@ -325,13 +2667,17 @@ def loadvars(filename: str = _DEFAULT_FILENAME, overwrite: Union[str, bool] = 'p
             log.info(f'overwrote existing variables {overwrote}')
         if len(did_not_overwrite) > 0:
             log.info(f'did not overwrite existing variables {did_not_overwrite}')
+        if report is not None:
+            for k in did_not_overwrite:
+                report.skipped[k] = 'not overwritten'
+            report.phases['assign'] = time.perf_counter() - phase
+            report.phases['total'] = time.perf_counter() - start
+            _emit_report(report, profile, log)
+        return report
 
 
 # useful utilities to ask question at console terminal with default answer and timeout
 
-import signal
-import time
-
 
 def _alarm_handler(signum, frame):
     raise TimeoutError
@@ -346,12 +2692,16 @@ def _input_with_timeout(prompt, timeout=30):
     :returns: the input
     :raises TimeoutError: if times out
     """
-    # set signal handler
+    # set signal handler; signals can only be handled on the main thread
+    if timeout is not None and threading.current_thread() is not threading.main_thread():
+        timeout = None
     if timeout is not None:
+        import signal
         signal.signal(signal.SIGALRM, _alarm_handler)
         signal.alarm(timeout)  # produce SIGALRM in `timeout` seconds
     try:
-        time.sleep(.5)  # get input to be printed after logging
+        sys.stdout.flush()  # get input to be printed after logging
+        sys.stderr.flush()
         return input(prompt)
     except TimeoutError as to:
         raise to
@@ -360,9 +2710,6 @@ def _input_with_timeout(prompt, timeout=30):
             signal.alarm(0)  # cancel alarm
 
 
-import os
-
-
 def _yes_or_no_or_always(question, default='y', timeout=None, always_option=True):
     """ Get Yes/No/Always answer with default choice and optional timeout
 
@@ -371,11 +2718,16 @@ def _yes_or_no_or_always(question, default='y', timeout=None, always_option=True
     :param timeout: the timeout in seconds, default is None. Does not work on windows.
     :param always_option: True to include, False to go to yes/no
 
-    :returns: 'yes' or 'no' or 'always'
+    :returns: 'yes' or 'no' or 'always'. Off the main thread the default answer is returned without prompting, since
+        reading stdin from a background thread would block it (forever in jupyter).
     """
     log = get_logger(_LOGGING_LEVEL)
     if default is not None and (default != 'y' and default != 'n'):
         raise ValueError(f'bad option for default: {default}; must be "y" or "n")')
+    if threading.current_thread() is not threading.main_thread():
+        log.warning(f'{question} answered {"yes" if default == "y" else "no"} without asking on a background thread; '
+                    f'pass a VarsPolicy to decide')
+        return 'yes' if default == 'y' else 'no'
     yes = 'Yes' if default == 'y' else 'yes'
     no = 'No' if default == 'n' else 'no'
     always = 'always'
@@ -389,7 +2741,6 @@ def _yes_or_no_or_always(question, default='y', timeout=None, always_option=True
         try:
             if not timeout is None and os.name == 'nt':
                 log.warning('cannot use timeout signal on windows')
-                time.sleep(.1)  # make the warning come out first
                 reply = str(input(quest_str)).lower().strip()
             else:
                 reply = str(_input_with_timeout(quest_str, timeout=timeout)).lower().strip()
@@ -404,3 +2755,7 @@ def _yes_or_no_or_always(question, default='y', timeout=None, always_option=True
             return no.lower()
         elif always_option and reply[0].lower() == 'a':
             return always.lower()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,7 +3,7 @@
 import logging
 
 from jupyter_save_load_vars import savevars,loadvars,printvars,_DEFAULT_FILENAME,_DILL_EXTENSION
-import functools, sys
+import functools, json, os, sys
 import time
 
 print = functools.partial(print, flush=True, file=sys.stderr)  # flush and put print() on stderr so logging comes in sequence
@@ -121,4 +121,595 @@ def test_vars_save_load(monkeypatch): # https://stackoverflow.com/questions/3585
 # uncomment to run this test from command line directly, just as a script
 # if __name__ == '__main__':
 #     test_nonexisting_file()
-#     test_vars_save_load()
\ No newline at end of file
+#     test_vars_save_load()
+
+def _in_workspace(code, workspace, **names):
+    """ runs code with the dict workspace as its locals, the way a notebook cell sees its variables """
+    exec(code, dict(savevars=savevars, loadvars=loadvars, printvars=printvars, **names), workspace)
+    return workspace
+
+
+class CountsPickling:
+    """ counts how many times instances are serialized """
+    count = 0
+
+    def __getstate__(self):
+        CountsPickling.count += 1
+        return {}
+
+    def __setstate__(self, state):
+        pass
+
+
+def test_savevars_serializes_once(tmp_path):
+    path = tmp_path / 'once'
+    CountsPickling.count = 0
+    _in_workspace('savevars(path, overwrite=True)', {'x': CountsPickling(), 'o': (i for i in []), 'c': 'string'},
+                  path=path)
+    assert CountsPickling.count == 1
+    workspace = _in_workspace('loadvars(path, warn=False)', {}, path=path)
+    assert isinstance(workspace['x'], CountsPickling) and workspace['c'] == 'string' and 'o' not in workspace
+
+
+def test_loadvars_selected_vars(tmp_path):
+    import dill
+    path = tmp_path / 'selected.dill'
+    _in_workspace('savevars(path)', {'a': 1, 'a1': [11], 'b': {'config': True}}, path=path)
+    assert _in_workspace('loadvars(path, warn=False, vars=["b"])', {}, path=path) == {'b': {'config': True}}
+    assert _in_workspace('loadvars(path, warn=False, vars="a*")', {}, path=path) == {'a': 1, 'a1': [11]}
+    try:
+        _in_workspace('loadvars(path, warn=False, vars=["c"])', {}, path=path)
+        raise AssertionError('c is not in the file')
+    except ValueError:
+        pass
+
+    legacy = tmp_path / 'legacy.dill'  # files written by savevars before the container format
+    with open(legacy, 'wb') as f:
+        dill.dump({'a': 1, 'b': [2, 3]}, f)
+    assert _in_workspace('loadvars(legacy, warn=False, vars="b")', {}, legacy=legacy) == {'b': [2, 3]}
+
+
+def test_array_buffers_out_of_band(tmp_path):
+    import pytest
+    np = pytest.importorskip('numpy')
+    path = tmp_path / 'arrays.dill'
+    arrays = {'x': np.arange(1000.), 'f': np.asfortranarray(np.ones((30, 20), dtype=np.int16)), 'y': [np.zeros(3)]}
+    _in_workspace('savevars(path)', dict(arrays), path=path)
+    assert path.stat().st_size < 2 * (arrays['x'].nbytes + arrays['f'].nbytes)  # array data was not duplicated
+    for use_mmap in (False, True):
+        workspace = _in_workspace('loadvars(path, warn=False, mmap=use_mmap)', {}, path=path, use_mmap=use_mmap)
+        assert np.array_equal(workspace['x'], arrays['x']) and np.array_equal(workspace['f'], arrays['f'])
+        assert workspace['f'].flags.f_contiguous and np.array_equal(workspace['y'][0], arrays['y'][0])
+        workspace['x'][0] = -1  # arrays are writable, also when memory mapped
+    workspace = _in_workspace('loadvars(path, warn=False)', {}, path=path)
+    assert workspace['x'][0] == 0  # writing to a memory mapped array did not change the file
+
+
+def test_loadvars_lazy(tmp_path):
+    from jupyter_save_load_vars import LazyVar
+    path = tmp_path / 'lazy.dill'
+    _in_workspace('savevars(path)', {'a': 3, 'b': [2, 3], 'c': 'string', 'd': {'k': 1}}, path=path)
+    workspace = _in_workspace('loadvars(path, warn=False, lazy=True)', {}, path=path)
+    assert all(type(v) is LazyVar for v in workspace.values())
+    assert 'list' in repr(workspace['b']) and 'not loaded' in repr(workspace['b'])
+    assert workspace['a'] + 1 == 4 and 1 + workspace['a'] == 4 and workspace['a'] * 2 == 6
+    assert len(workspace['b']) == 2 and workspace['b'][1] == 3 and list(workspace['b']) == [2, 3]
+    assert isinstance(workspace['c'], str) and workspace['c'].upper() == 'STRING' and str(workspace['c']) == 'string'
+    assert workspace['d'].materialize() == {'k': 1} and repr(workspace['d']) == repr({'k': 1})
+
+    workspace = _in_workspace('loadvars(path, warn=False, lazy=True)', {}, path=path)
+    _in_workspace('savevars(path2)', workspace, path2=tmp_path / 'lazy2.dill')  # saves the values, not placeholders
+    assert _in_workspace('loadvars(path2, warn=False)', {}, path2=tmp_path / 'lazy2.dill') == \
+           {'a': 3, 'b': [2, 3], 'c': 'string', 'd': {'k': 1}}
+
+
+def test_lazyvar_ipython_display(tmp_path, capsys):
+    import pytest
+    formatters = pytest.importorskip('IPython.core.formatters')
+    from jupyter_save_load_vars import LazyVar
+    path = tmp_path / 'display.dill'
+    _in_workspace('savevars(path)', {'b': [2, 3]}, path=path)
+    b = _in_workspace('loadvars(path, warn=False, lazy=True)', {}, path=path)['b']
+    formatters.DisplayFormatter().format(b)
+    assert 'not loaded' in capsys.readouterr().out
+    assert isinstance(b, list) and b._lazyvar_value is LazyVar._NOT_LOADED  # the type comes from the index
+    assert b.materialize() == [2, 3]
+    formatters.DisplayFormatter().format(b)
+    assert '[2, 3]' in capsys.readouterr().out
+
+
+def test_savevars_incremental(tmp_path):
+    from jupyter_save_load_vars import compactvars, _ContainerReader
+    path = tmp_path / 'incremental.dill'
+
+    def offsets():
+        with open(path, 'rb') as f:
+            return {e['name']: e['offset'] for e in _ContainerReader(f).index}
+
+    workspace = {'a': 1, 'b': [1, 2], 'c': 'string', 'big': list(range(10000))}
+    _in_workspace('savevars(path, overwrite=True, incremental=True)', workspace, path=path)
+    first, size = offsets(), path.stat().st_size
+    workspace['b'].append(3)
+    del workspace['c']
+    workspace['d'] = {'new': True}
+    _in_workspace('savevars(path, overwrite=True, incremental=True)', workspace, path=path)
+    second = offsets()
+    assert second['a'] == first['a'] and second['big'] == first['big'] and second['b'] > first['b']
+    assert 'c' not in second and path.stat().st_size < size + 1000  # big was not written again
+    size = path.stat().st_size
+    _in_workspace('savevars(path, overwrite=True, incremental=True)', workspace, path=path)
+    assert path.stat().st_size == size  # nothing changed, nothing written
+
+    expected = {'a': 1, 'b': [1, 2, 3], 'big': list(range(10000)), 'd': {'new': True}}
+    assert _in_workspace('loadvars(path, warn=False)', {}, path=path) == expected
+    compactvars(path)
+    assert path.stat().st_size < size
+    assert _in_workspace('loadvars(path, warn=False)', {}, path=path) == expected
+    workspace['a'] = 2  # still appends after compacting
+    _in_workspace('savevars(path, overwrite=True, incremental=True)', workspace, path=path)
+    assert _in_workspace('loadvars(path, warn=False, vars="a")', {}, path=path) == {'a': 2}
+
+
+def test_parallel_workers(tmp_path):
+    import multiprocessing
+    workspace = {f'v{i}': {'i': i, 'items': list(range(i * 100))} for i in range(20)}
+    workspace['o'] = (i for i in [])
+    workspace['s'] = 'string'
+    options = {'w1': dict(workers=1), 'w4': dict(workers=4)}
+    if 'fork' in multiprocessing.get_all_start_methods():
+        options['p4'] = dict(workers=4, processes=True)  # the dicts are pickled in forked processes
+    for name, kwargs in options.items():
+        _in_workspace('savevars(path, **kwargs)', dict(workspace), path=tmp_path / f'{name}.dill', kwargs=kwargs)
+    from jupyter_save_load_vars import _ContainerReader
+    records = []
+    for name in options:
+        with open(tmp_path / f'{name}.dill', 'rb') as f:
+            reader = _ContainerReader(f)
+            f.seek(0)
+            records.append((f.read(reader.index_offset), reader.index))
+    assert all(r == records[0] for r in records)  # same order, same records; only the save time in the index differs
+    del workspace['o']
+    for name in options:
+        loaded = _in_workspace('loadvars(path, warn=False, workers=4)', {}, path=tmp_path / f'{name}.dill')
+        assert list(loaded) == list(workspace) and loaded == workspace
+
+
+def test_compression(tmp_path):
+    import os
+    from jupyter_save_load_vars import _AUTO_CODECS
+    workspace = {'text': 'repetitive ' * 10000, 'small': 1, 'noise': os.urandom(100000)}
+    _in_workspace('savevars(path)', dict(workspace), path=tmp_path / 'raw.dill')
+    raw_size = (tmp_path / 'raw.dill').stat().st_size
+    for compression in ('gzip', 'lzma', 'auto'):
+        path = tmp_path / f'{compression}.dill'
+        _in_workspace('savevars(path, compression=compression)', dict(workspace), path=path, compression=compression)
+        assert path.stat().st_size < raw_size - 100000  # text compressed, noise stored as it is
+        assert _in_workspace('loadvars(path, warn=False, workers=2)', {}, path=path) == workspace
+    try:
+        _in_workspace('savevars(path, compression="rar")', dict(workspace), path=tmp_path / 'rar.dill')
+        raise AssertionError('rar is not a codec')
+    except ValueError:
+        pass
+
+
+def test_compressed_arrays(tmp_path):
+    import pytest
+    np = pytest.importorskip('numpy')
+    path = tmp_path / 'arrays.dill'
+    workspace = {'zeros': np.zeros((500, 100)), 'ramp': np.arange(100000, dtype=np.int32)}
+    _in_workspace('savevars(path, compression="gzip")', dict(workspace), path=path)
+    assert path.stat().st_size < sum(v.nbytes for v in workspace.values()) / 2
+    loaded = _in_workspace('loadvars(path, warn=False, mmap=True)', {}, path=path)
+    assert all(np.array_equal(loaded[k], workspace[k]) for k in workspace)
+    loaded['zeros'][0, 0] = 1  # decompressed arrays are writable
+
+
+def test_savevars_background(tmp_path):
+    from jupyter_save_load_vars import SaveHandle
+    path = tmp_path / 'background.dill'
+    workspace = {'a': 1, 'b': [2, 3], 'o': (i for i in [])}
+    handle = _in_workspace('handle = savevars(path, background=True, compression="gzip")', workspace, path=path)['handle']
+    assert isinstance(handle, SaveHandle)
+    handle.wait(timeout=30)
+    assert handle.done() and handle.error is None and handle.progress == 1.0
+    assert _in_workspace('loadvars(path, warn=False)', {}, path=path) == {'a': 1, 'b': [2, 3]}
+
+
+def test_savevars_background_snapshots_arrays(tmp_path):
+    import pytest
+    np = pytest.importorskip('numpy')
+    path = tmp_path / 'snapshot.dill'
+    workspace = {'x': np.zeros(1000000)}
+    handle = _in_workspace('handle = savevars(path, background=True)', workspace, path=path)['handle']
+    workspace['x'][:] = 1  # changed after savevars returned, must not change what is saved
+    loaded = _in_workspace('loadvars(path, warn=False)', {}, path=path)  # waits for the background save
+    assert handle.done() and not loaded['x'].any()
+
+
+def test_incremental_savevars_appends_without_prompting(tmp_path, monkeypatch):
+    from jupyter_save_load_vars import VarsPolicy
+
+    def no_input(prompt):
+        raise AssertionError(f'prompted: {prompt}')
+
+    path = tmp_path / 'cells.dill'
+    workspace = {'a': 1}
+    _in_workspace('savevars(path, incremental=True)', workspace, path=path)
+    monkeypatch.setattr('builtins.input', no_input)
+    workspace['b'] = 2  # as after the next cell
+    _in_workspace('savevars(path, incremental=True)', workspace, path=path)
+    workspace['c'] = 3
+    _in_workspace('savevars(path, incremental=True, policy=VarsPolicy(overwrite_files=False))', workspace, path=path,
+                  VarsPolicy=VarsPolicy)
+    assert _in_workspace('loadvars(path, warn=False)', {}, path=path) == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_incremental_savevars_waits_for_background(tmp_path, monkeypatch):
+    import threading
+    import jupyter_save_load_vars
+    path = tmp_path / 'inc.dill'
+    workspace = {'a': [0] * 1000, 'n': 0}
+    _in_workspace('savevars(path, overwrite=True, incremental=True)', workspace, path=path)
+    add = jupyter_save_load_vars._ContainerWriter.add
+
+    def slow_add(self, *args, **kwargs):  # keeps the background save writing while the next save starts
+        if threading.current_thread() is not threading.main_thread():
+            time.sleep(0.2)
+        return add(self, *args, **kwargs)
+
+    monkeypatch.setattr(jupyter_save_load_vars._ContainerWriter, 'add', slow_add)
+    workspace['a'] = [1] * 1000
+    _in_workspace('savevars(path, overwrite=True, incremental=True, background=True)', workspace, path=path)
+    workspace['n'] = 1
+    _in_workspace('savevars(path, overwrite=True, incremental=True)', workspace, path=path)
+    loaded = _in_workspace('loadvars(path, warn=False, verify=True)', {}, path=path)
+    assert loaded == {'a': [1] * 1000, 'n': 1}
+
+
+def test_atomic_savevars(tmp_path, monkeypatch):
+    import jupyter_save_load_vars
+    path = tmp_path / 'atomic.dill'
+    for a in (1, 2, 3):
+        _in_workspace('savevars(path, overwrite=True, keep=2)', {'a': a}, path=path)
+    for p, a in ((path, 3), (tmp_path / 'atomic.dill.1', 2), (tmp_path / 'atomic.dill.2', 1)):
+        assert _in_workspace('loadvars(p, warn=False, verify=True)', {}, p=p) == {'a': a}
+
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(jupyter_save_load_vars._ContainerWriter, 'close', fail)
+    try:
+        _in_workspace('savevars(path, overwrite=True)', {'a': 4}, path=path)
+        raise AssertionError('savevars should raise the error')
+    except OSError:
+        pass
+    assert _in_workspace('loadvars(path, warn=False)', {}, path=path) == {'a': 3}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['atomic.dill', 'atomic.dill.1', 'atomic.dill.2']
+
+    monkeypatch.undo()
+    add = jupyter_save_load_vars._ContainerWriter.add
+
+    def corrupt(self, *args, **kwargs):  # a byte of the record changes on its way to the file
+        offset = self.pos
+        add(self, *args, **kwargs)
+        self.f.flush()
+        os.pwrite(self.f.fileno(), b'\xff', offset + 1)
+
+    monkeypatch.setattr(jupyter_save_load_vars._ContainerWriter, 'add', corrupt)
+    try:
+        _in_workspace('savevars(path, overwrite=True)', {'a': 5}, path=path)
+        raise AssertionError('the checksum of the written bytes should not match')
+    except ValueError:
+        pass
+    assert _in_workspace('loadvars(path, warn=False)', {}, path=path) == {'a': 3}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['atomic.dill', 'atomic.dill.1', 'atomic.dill.2']
+
+
+def test_interrupted_append_and_checksum(tmp_path):
+    path = tmp_path / 'crash.dill'
+    workspace = {'a': 1, 'b': 'string'}
+    _in_workspace('savevars(path, incremental=True)', workspace, path=path)
+    workspace['a'] = 2
+    _in_workspace('savevars(path, overwrite=True, incremental=True)', workspace, path=path)
+    with open(path, 'r+b') as f:  # as if the process died while writing the new trailer
+        f.truncate(path.stat().st_size - 5)
+    assert _in_workspace('loadvars(path, warn=False)', {}, path=path) == {'a': 2, 'b': 'string'}
+    with open(path, 'r+b') as f:  # as if it died while writing the new index
+        f.truncate(path.stat().st_size - 20)
+    assert _in_workspace('loadvars(path, warn=False, verify=True)', {}, path=path) == {'a': 1, 'b': 'string'}
+
+    data = bytearray(path.read_bytes())
+    data[data.index(b'string')] = ord('S')
+    path.write_bytes(bytes(data))
+    try:
+        _in_workspace('loadvars(path, warn=False, verify=True)', {}, path=path)
+        raise AssertionError('the checksum should not match')
+    except ValueError:
+        pass
+
+
+def test_benchmark_runs(tmp_path):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+    import bench_saveloadvars
+    path = str(tmp_path / 'bench.dill')
+    for operation in bench_saveloadvars.OPERATIONS:
+        result = bench_saveloadvars.run_child('nested', operation, path, 0.01, 1, {}, {})
+        assert result['variables'] == 20 and result['seconds'] >= 0
+
+
+def test_profile_report(tmp_path):
+    path = tmp_path / 'profile.dill'
+    reports = []
+    workspace = {'a': list(range(10000)), 'b': 'string', 'g': (i for i in range(3))}
+    report = _in_workspace('report = savevars(path, compression="gzip", profile=reports.append)', workspace,
+                           path=path, reports=reports)['report']
+    assert reports == [report] and report.operation == 'savevars'
+    assert set(report.variables) == {'a', 'b'} and 'g' in report.skipped
+    a = report.variables['a']
+    assert a['type'] == 'list' and a['raw'] > a['stored'] > 0 and a['ratio'] > 1 and a['serialize'] > 0
+    assert {'select', 'serialize', 'write', 'total'} <= set(report.phases)
+    assert 'a ' in str(report)
+
+    report = _in_workspace('report = loadvars(path, warn=False, profile=True)', {}, path=path)['report']
+    assert report.operation == 'loadvars' and set(report.variables) == {'a', 'b'}
+    assert report.variables['a']['stored'] == a['stored'] and report.variables['a']['deserialize'] > 0
+
+
+def test_store_deduplicates(tmp_path):
+    from jupyter_save_load_vars import gcvars
+    store = tmp_path / 'store'
+    table = list(range(50000))  # large enough to go to the store
+    for run in ('run1', 'run2'):
+        _in_workspace('savevars(path, store=store)', {'table': table, 'run': run},
+                      path=tmp_path / run, store=store)
+    blobs = list((store / 'objects').glob('*/*'))
+    assert len(blobs) == 1 and (tmp_path / 'run2.dill').stat().st_size < 1000
+    assert _in_workspace('loadvars(path, warn=False)', {}, path=tmp_path / 'run2') == {'table': table, 'run': 'run2'}
+
+    _in_workspace('savevars(path, overwrite=True, store=store)', {'table': table[::-1]}, path=tmp_path / 'run1',
+                  store=store)
+    assert gcvars(store) == (0, 0)  # run2 still refers to the first table
+    (tmp_path / 'run2.dill').unlink()
+    assert gcvars(store)[0] == 1
+    assert not blobs[0].exists()
+    assert _in_workspace('loadvars(path, warn=False)', {}, path=tmp_path / 'run1') == {'table': table[::-1]}
+
+
+def test_listvars(tmp_path, capsys):
+    import numpy as np
+    from jupyter_save_load_vars import listvars, main
+    path = tmp_path / 'list.dill'
+    _in_workspace('savevars(path)', {'a': np.zeros((3, 4), dtype=np.float32), 'b': 'string'}, path=path)
+    a, b = listvars(path)
+    assert a['name'] == 'a' and a['type'] == 'numpy.ndarray' and a['shape'] == [3, 4] and a['dtype'] == 'float32'
+    assert a['size'] == 48 and a['stored'] >= 48 and a['saved'] == b['saved'] is not None
+    assert b['type'] == 'str' and 'shape' not in b
+    assert [v['name'] for v in listvars(path, vars='b*')] == ['b']
+
+    assert main([str(path), '--json']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)['name'] for line in lines] == ['a', 'b']
+    assert main([str(tmp_path / 'missing')]) == 1
+
+
+def test_unpicklable_types_cache(tmp_path, monkeypatch):
+    import jupyter_save_load_vars
+    from jupyter_save_load_vars import unpicklable_types
+    unpicklable_types(clear=True)
+    workspace = {'g': (i for i in range(3)), 'l': [(i for i in range(3))], 'a': 1}
+    _in_workspace('savevars(path)', workspace, path=tmp_path / 'cache')
+    assert unpicklable_types() == {'generator': "cannot pickle 'generator' object"}  # not list, its item failed
+
+    dumped = []
+    dumps = jupyter_save_load_vars._dumps
+    monkeypatch.setattr(jupyter_save_load_vars, '_dumps', lambda v: dumped.append(v) or dumps(v))
+    _in_workspace('savevars(path, overwrite=True)', workspace, path=tmp_path / 'cache')
+    assert workspace['g'] not in dumped and len(dumped) == 2  # the generator is skipped without trying
+    assert unpicklable_types(clear=True) and unpicklable_types() == {}
+
+
+def test_file_objects(tmp_path):
+    import io
+    buffer = io.BytesIO()
+    workspace = {'a': list(range(1000)), 'b': 'string', 'g': (i for i in range(3))}
+    _in_workspace('savevars(buffer, compression="gzip", compression_threshold=0)', workspace, buffer=buffer)
+    data = buffer.getvalue()
+    assert _in_workspace('loadvars(io.BytesIO(data), warn=False, verify=True, workers=2)', {}, io=io, data=data) \
+           == {'a': workspace['a'], 'b': 'string'}
+    assert _in_workspace('loadvars(io.BytesIO(data), warn=False, vars="b*")', {}, io=io, data=data) == {'b': 'string'}
+    try:
+        _in_workspace('loadvars(io.BytesIO(data[:-40]), warn=False)', {}, io=io, data=data)
+        raise AssertionError('a truncated stream should not load')
+    except ValueError:
+        pass
+    empty = io.BytesIO()  # nothing could be pickled, the empty container still loads
+    _in_workspace('savevars(empty)', {'g': workspace['g']}, empty=empty)
+    assert _in_workspace('loadvars(io.BytesIO(data), warn=False, verify=True)', {}, io=io, data=empty.getvalue()) == {}
+    try:
+        _in_workspace('savevars(buffer, incremental=True)', {'a': 1}, buffer=io.BytesIO())
+        raise AssertionError('incremental saves need a filename')
+    except ValueError:
+        pass
+
+    path = tmp_path / 'appended.dill'  # files with appended records read sequentially as well
+    workspace = {'a': 1, 'b': 2}
+    _in_workspace('savevars(path, incremental=True)', workspace, path=path)
+    workspace['a'] = 3
+    del workspace['b']
+    _in_workspace('savevars(path, overwrite=True, incremental=True)', workspace, path=path)
+    with open(path, 'rb') as f:
+        assert _in_workspace('loadvars(f, warn=False, verify=True)', {}, f=f) == {'a': 3}
+
+
+def test_native_formats(tmp_path):
+    import pytest
+    np = pytest.importorskip('numpy')
+    pd = pytest.importorskip('pandas')
+    pytest.importorskip('pyarrow')
+    from jupyter_save_load_vars import listvars
+    path = tmp_path / 'native.dill'
+    workspace = {'a': np.arange(12.).reshape(3, 4), 'f': np.asfortranarray(np.ones((3, 2), dtype=np.int16)),
+                 'o': np.array([1, 'x'], dtype=object), 'dt': np.array(['2024-01-02', 'NaT'], dtype='datetime64[D]'),
+                 'td': np.array([1, 2], dtype='timedelta64[s]'),
+                 'df': pd.DataFrame({'x': [1, 2], 'y': ['a', 'b']}, index=['p', 'q']),
+                 'mixed': pd.DataFrame({'m': [1, 'x']}), 's': pd.Series([1.5, 2.5], name='s'),
+                 'dup': pd.DataFrame([[1, 2]], columns=['a', 'a'])}
+    for native in (True, 'parquet'):
+        _in_workspace('savevars(path, overwrite=True, native=native)', dict(workspace), path=path, native=native)
+        formats = {v['name']: v.get('format') for v in listvars(path)}
+        frames = 'parquet' if native == 'parquet' else 'arrow'
+        assert formats == {'a': 'npy', 'f': 'npy', 'o': None, 'dt': None, 'td': None, 'df': frames, 'mixed': None,
+                           's': frames, 'dup': None}  # datetime64, timedelta64 and duplicate columns are pickled
+        for use_mmap in (False, True):
+            loaded = _in_workspace('loadvars(path, warn=False, mmap=use_mmap)', {}, path=path, use_mmap=use_mmap)
+            assert np.array_equal(loaded['a'], workspace['a']) and loaded['f'].flags.f_contiguous
+            assert list(loaded['o']) == [1, 'x']
+            for k in ('dt', 'td'):
+                np.testing.assert_array_equal(loaded[k], workspace[k])
+            for k in ('df', 'mixed', 'dup'):
+                pd.testing.assert_frame_equal(loaded[k], workspace[k])
+            pd.testing.assert_series_equal(loaded['s'], workspace['s'])
+        loaded = _in_workspace('loadvars(path, warn=False, vars=["df", "mixed"], columns={"df": ["y"], "mixed": ["m"]})',
+                               {}, path=path)
+        pd.testing.assert_frame_equal(loaded['df'], workspace['df'][['y']])
+        pd.testing.assert_frame_equal(loaded['mixed'], workspace['mixed'])
+
+
+def test_import_is_fast(tmp_path):
+    import subprocess
+    import jupyter_save_load_vars
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(jupyter_save_load_vars.__file__)),
+               PYTHONPYCACHEPREFIX=str(tmp_path))  # compiled once, as in an installed package
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    def import_time(module):
+        """ :returns: the cumulative import time of module in microseconds, and the heavy modules it imported """
+        heavy = '{"dill", "inspect", "signal", "tempfile", "numpy"}'
+        code = f'import {module}, sys; print(*sorted({heavy} & set(sys.modules)))'
+        child = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True,
+                               text=True, check=True)
+        line = [line for line in child.stderr.splitlines() if line.endswith(f'| {module}')][-1]
+        return int(line.split('|')[1]), child.stdout.split()
+
+    import_time('jupyter_save_load_vars')  # writes the bytecode
+    microseconds, imported = import_time('jupyter_save_load_vars')
+    assert imported == []  # dill and friends are imported when they are first needed
+    assert microseconds < import_time('dill')[0]  # the budget: less than importing dill alone takes
+
+
+def test_namespaces_and_shards(tmp_path):
+    import threading
+    import pytest
+    np = pytest.importorskip('numpy')
+    from jupyter_save_load_vars import saveshard, mergeshards, gathervars
+    path = tmp_path / 'namespace.dill'
+    savevars(path, namespace={'a': 1, 'b': [2], '_hidden': 3})
+    namespace = {}
+    loadvars(path, warn=False, namespace=namespace)
+    assert namespace == {'a': 1, 'b': [2]}
+
+    sweep = tmp_path / 'sweep'
+
+    def work(writer):
+        for i in range(5):
+            namespace = {'x': np.full(3, 10 * writer + i), 'lr': i / 10}
+            saveshard(sweep, {f'run{writer}{i}': namespace}, writer=str(writer % 2))
+
+    threads = [threading.Thread(target=work, args=(w,)) for w in range(4)]  # two pairs of writers share a shard
+    for t in threads:
+        t.start()
+    mergeshards(sweep)  # while writing
+    for t in threads:
+        t.join()
+    keys, xs = gathervars(sweep, 'x', stack=True, keys=True)
+    assert keys == sorted(f'run{w}{i}' for w in range(4) for i in range(5)) and xs.shape == (20, 3)
+    assert [x[0] for x in xs] == [int(k[3:]) for k in keys]
+    saveshard(sweep, {'run00': {'lr': 1.0}}, writer='new')  # replaces the namespace
+    mergeshards(sweep)
+    assert sorted(p.name for p in sweep.glob('*.dill')) == ['merged.dill']
+    assert len(gathervars(sweep, 'x')) == 19 and gathervars(sweep, 'lr')[0] == 1.0
+
+
+def test_policy(tmp_path, monkeypatch):
+    import threading
+    from jupyter_save_load_vars import VarsPolicy
+
+    def no_input(prompt):
+        raise AssertionError(f'prompted: {prompt}')
+
+    monkeypatch.setattr('builtins.input', no_input)
+    path = tmp_path / 'policy.dill'
+    savevars(path, namespace={'a': 1, 'b': 2, 'c': 3})
+    _in_workspace('savevars(path, policy=VarsPolicy(overwrite_files=False))', {'a': 0}, path=path,
+                  VarsPolicy=VarsPolicy)
+    policy = VarsPolicy(overwrite={'a': False, '*': True}, trusted=str(tmp_path / '*'))
+    workspace = _in_workspace('loadvars(path, policy=policy)', {'a': -1, 'b': -2}, path=path, policy=policy)
+    assert workspace == {'a': -1, 'b': 2, 'c': 3}
+    try:
+        loadvars(path, policy=VarsPolicy(trusted=['/elsewhere/*']))
+        raise AssertionError('the file is not trusted')
+    except PermissionError:
+        pass
+
+    answers = []  # prompts answer their default on background threads
+    thread = threading.Thread(target=lambda: answers.append(loadvars(path, namespace={})))
+    thread.start()
+    thread.join()
+    assert answers == [None]
+
+
+def test_max_memory(tmp_path):
+    import io
+    import pytest
+    np = pytest.importorskip('numpy')
+    from jupyter_save_load_vars import LazyVar
+    path = tmp_path / 'budget.dill'
+    workspace = {'big': np.ones(100_000), 'small': np.ones(10), 'medium': np.ones(10_000), 's': 'string'}
+    savevars(path, namespace=workspace)
+    loaded = {}
+    report = loadvars(path, warn=False, namespace=loaded, max_memory=200_000, profile=True)
+    assert list(loaded) == ['big', 'small', 'medium', 's']  # in the order of the file
+    assert type(loaded['big']) is LazyVar and list(report.deferred) == ['big']
+    assert all(type(loaded[k]) is not LazyVar for k in ('small', 'medium', 's'))
+    assert np.array_equal(loaded['big'].materialize(), workspace['big'])
+    loaded = {}
+    loadvars(path, warn=False, namespace=loaded, max_memory=200_000, mmap=True)  # mapped data does not count
+    assert not any(type(v) is LazyVar for v in loaded.values())
+
+    with open(path, 'rb') as f:
+        loaded = {}
+        loadvars(io.BytesIO(f.read()), warn=False, namespace=loaded, max_memory=200_000)
+    assert sorted(loaded) == ['medium', 's', 'small']  # streams are loaded in order, big does not fit
+
+
+def test_whosvars(tmp_path, capsys):
+    import pytest
+    np = pytest.importorskip('numpy')
+    from jupyter_save_load_vars import whosvars
+    workspace = {'a': np.zeros((100, 10)), 'rows': [[i] * 10 for i in range(100)], 's': ''.join(['te', 'xt']), 'n': 3}
+    workspace['b'] = b'x' * 100000
+    references = sys.getrefcount(workspace['b'])
+    savevars(tmp_path / 'whos.dill', namespace=workspace, incremental=True)
+    after = sys.getrefcount(workspace['b'])
+    assert after == references  # savevars keeps no reference to the saved values
+    del workspace['b']
+    workspace['a'][0, 0] = 1
+    workspace['n'] = 4
+    workspace['new'] = {'x': 1}
+    variables = {v['name']: v for v in whosvars(namespace=workspace)}
+    assert list(variables) == ['rows', 'a', 'new', 's', 'n']  # largest first
+    assert variables['a']['deep_size'] == 8000 and variables['a']['shape'] == [100, 10]
+    assert variables['rows']['deep_size'] > variables['rows']['size'] and variables['rows']['complete']
+    assert {k: v['changed'] for k, v in variables.items()} == \
+           {'a': True, 'rows': False, 's': False, 'n': True, 'new': None}
+    savevars(tmp_path / 'plain.dill', vars=['a', 'new'], namespace=workspace)  # plain saves count too
+    workspace['new']['x'] = 2
+    changed = {v['name']: v['changed'] for v in whosvars(namespace=workspace)}
+    assert changed == {'a': False, 'rows': False, 's': False, 'n': True, 'new': True}
+    workspace['s'] = 'text'  # an equal value is not a change
+    assert all(v['serialized'] > 0 for v in variables.values())
+    assert 'rows' in capsys.readouterr().out
+
+    variables = {v['name']: v for v in whosvars(namespace=workspace, time_budget=0)}
+    assert variables['rows']['serialized'] is None and not variables['rows']['complete']
+    assert variables['n']['changed'] is True and variables['s']['changed'] is False  # immutables are not serialized